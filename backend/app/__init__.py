@@ -47,10 +47,15 @@ def create_app(config_class=Config):
 
         # 必须在 app 上下文中导入模型
         with app.app_context():
-            from app.models import User, Graph, QueryCache  # 显式导入模型
+            from app.models import User, Graph, QueryCache, add_missing_columns  # 显式导入模型
             
             # 创建数据库表（仅开发环境使用）
             db.create_all()
+            # 已有的表补上新增的列
+            add_missing_columns()
+            # 上次退出时仍在构建的图重新提交构建
+            from app.routes.graph import requeue_pending_builds
+            requeue_pending_builds(app)
 
         return app
     except Exception as e:
@@ -0,0 +1,158 @@
+"""
+the peeling of every k and every connected component of the k-core is independent: the threshold
+of a vertex is the largest eta such that it stays in the (k, eta)-core, which only depends on its
+own component. so the index is built from (k, component) work units peeled in worker processes.
+every unit is shipped as a compact relabelled SparseGraph and the results are merged in the order
+of k and of the components, so the output does not depend on the scheduling.
+"""
+import heapq
+import logging
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+from app.algo.UCO import uco as UCO
+from app.algo.decorate import wrapper
+from app.algo.sparse_graph import SparseGraph, as_sparse_graph
+from app.algo.utils import connected_components, core_decomposition
+
+
+# small units are packed together until a task owns this many edges
+TASK_EDGES = 1 << 14
+
+
+class WorkUnit:
+    """one connected component of the k-core, vertexes[i] is vertex i of graph"""
+    __slots__ = ('k', 'vertexes', 'graph')
+
+    def __init__(self, k: int, vertexes: List[int], graph: SparseGraph):
+        self.k = k
+        self.vertexes = vertexes
+        self.graph = graph
+
+
+def work_units(graph: SparseGraph, ks: Iterable[int], core: List[int] = None) -> List[WorkUnit]:
+    """
+    split every k of ks into the connected components of the k-core of graph
+    :param graph: not changed
+    :param ks: the k numbers
+    :param core: the core numbers of graph if they are known already
+    :return: the units ordered by k and then by the smallest vertex of the component
+    """
+    core = core if core is not None else core_decomposition(graph)
+    units = []
+    for k in sorted(ks):
+        members = [v for v, c in enumerate(core) if c >= k]
+        if len(members) == 0:
+            continue
+        for component in connected_components(graph.restrict(members), members):
+            units.append(WorkUnit(k, component, graph.induced_subgraph(component)))
+
+    return units
+
+
+def pack_tasks(units: List[WorkUnit], task_edges: int = None) -> List[List[int]]:
+    """
+    group the indexes of units into tasks, the biggest first so that the long units do not
+    end up at the tail of the schedule
+    """
+    task_edges = task_edges or TASK_EDGES
+    tasks, current, size = [], [], 0
+    for i in sorted(range(len(units)), key=lambda i: units[i].graph.edge_num(), reverse=True):
+        current.append(i)
+        size += units[i].graph.edge_num()
+        if size >= task_edges:
+            tasks.append(current)
+            current, size = [], 0
+    if current:
+        tasks.append(current)
+
+    return tasks
+
+
+def peel_task(task: List[Tuple[int, SparseGraph]], cut_off: float):
+    """
+    run in the workers: prune and peel every (k, graph) of the task
+    :return: (peeled vertexes, thresholds) per unit in the order of removal, and the PruningStats
+    """
+    stats = UCO.PruningStats()
+    res = []
+    for k, graph in task:
+        order, thresholds = array('i'), array('d')
+        vertexes = UCO.prune(graph, k, cut_off=cut_off, stats=stats)
+        for u, cur_thres in UCO.peel(graph, k, vertexes, stats):
+            order.append(u)
+            thresholds.append(cur_thres)
+        res.append((order, thresholds))
+
+    return res, stats
+
+
+def peel_in_parallel(graph: SparseGraph, ks: Iterable[int], cut_off: float = UCO.CUT_OFF,
+                     workers: int = None, stats: UCO.PruningStats = None,
+                     core: List[int] = None) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    the peeling of graph for every k of ks, computed per (k, component) unit
+    :param graph: not changed
+    :param ks: the k numbers
+    :param cut_off: the vertexes which can not pass it are pruned, see UCO.prune
+    :param workers: the number of processes, os.cpu_count() by default. 1 runs in this process
+    :param stats: sum of the PruningStats of the workers
+    :param core: the core numbers of graph if they are known already
+    :return: {k: [(vertex, threshold)]}, ascending by threshold like the output of UCO.peel.
+        the vertexes with the same threshold are ordered by the component they belong to
+    """
+    units = work_units(graph, ks, core)
+    packed = pack_tasks(units)
+    tasks = [[(units[i].k, units[i].graph) for i in task] for task in packed]
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1 or len(tasks) <= 1:
+        outputs = [peel_task(task, cut_off) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+            outputs = list(executor.map(peel_task, tasks, [cut_off] * len(tasks)))
+
+    peeled = [None for _ in units]
+    for task, (res, task_stats) in zip(packed, outputs):
+        for i, (order, thresholds) in zip(task, res):
+            vertexes = units[i].vertexes
+            peeled[i] = [(vertexes[u], thres) for u, thres in zip(order, thresholds)]
+        if stats is not None:
+            stats.merge(task_stats)
+
+    res = {k: [] for k in ks}
+    for k in res:
+        sequences = [peeled[i] for i, unit in enumerate(units) if unit.k == k]
+        res[k] = list(heapq.merge(*sequences, key=lambda x: x[1]))
+
+    return res
+
+
+@wrapper
+def parallel_UCO_Index(graph: SparseGraph, filename: str = 'default', workers: int = None,
+                       stats: UCO.PruningStats = None):
+    """
+    the same order as UCO.UCO_Index, built from (k, component) units in worker processes
+    :param graph: not changed
+    :param filename: used by the log
+    :param workers: the number of processes, os.cpu_count() by default
+    :param stats: count the pruned vertexes and the DP evaluations
+    :return: order, order[v][k - 1] is the threshold of v for k
+    """
+    graph = as_sparse_graph(graph)
+    stats = stats if stats is not None else UCO.PruningStats()
+    core = core_decomposition(graph)
+    # the (k, eta)-core lies in the k-core, so no threshold is left above the largest core number
+    levels = peel_in_parallel(graph, range(1, max(core, default=0) + 1), UCO.CUT_OFF, workers, stats, core)
+
+    order = [[] for _ in range(len(graph))]
+    for k in sorted(levels):
+        for u, thres in levels[k]:
+            # the thresholds never grow with k, so the kept ones are a prefix of every row
+            if thres > UCO.CUT_OFF:
+                order[u].append(thres)
+
+    logging.info('parallel_UCO_Index of %s: %s', filename, stats)
+    return order
@@ -0,0 +1,140 @@
+"""
+the k-prob DP of UCO on taichi (ti.cpu). the CSR arrays and the deletion mask of the graph are kept
+in taichi fields and the DP of a whole frontier runs as one kernel, one vertex per thread.
+the kernel follows degree_distribution step by step and fast math is off, so the k-probs are the
+same as the ones of the python path. a launch costs a few hundred microseconds, so it only pays
+off for big frontiers, the small ones are left to the python path.
+taichi is optional, use available() before selecting the 'taichi' backend.
+"""
+from typing import List
+
+import numpy as np
+
+from app.algo.sparse_graph import SparseGraph
+
+try:
+    import taichi as ti
+except ImportError:
+    ti = None
+
+
+_initialized = False
+_current = None
+
+
+def available() -> bool:
+    return ti is not None
+
+
+def init():
+    global _initialized
+    if ti is None:
+        raise ImportError("the taichi backend needs taichi, pip install taichi")
+    if not _initialized:
+        ti.init(arch=ti.cpu, default_fp=ti.f64, fast_math=False, log_level=ti.WARN)
+        _initialized = True
+
+
+def frontier_of(graph: SparseGraph) -> 'TaichiGraph':
+    """
+    the TaichiGraph of the CSR arrays of graph with its current probabilities and deletion mask.
+    the graphs made by copy and restrict share the arrays, so the fields of the last graph are
+    reused. set_prob and set_probs change the probabilities in place, so they are uploaded
+    again with the mask
+    """
+    global _current
+    init()
+    if _current is None or not _current.holds(graph):
+        if _current is not None:
+            _current.destroy()
+        _current = TaichiGraph(graph)
+    else:
+        _current.load_probs(graph)
+    _current.load_mask(graph)
+    return _current
+
+
+if ti is not None:
+    @ti.data_oriented
+    class TaichiGraph:
+        """the fields of one SparseGraph, see frontier_of"""
+
+        def __init__(self, graph: SparseGraph):
+            self.arrays = (graph.offsets, graph.neighbors, graph.probs)
+            n, m = len(graph), max(len(graph.neighbors), 1)
+            # the loops of taichi count in i32, so are the offsets
+            assert m < 2 ** 31, "the taichi backend takes less than 2 ** 31 edge ends"
+
+            builder = ti.FieldsBuilder()
+            self.offsets = ti.field(ti.i32)
+            self.neighbors = ti.field(ti.i32)
+            self.probs = ti.field(ti.f64)
+            self.removed = ti.field(ti.u8)
+            builder.dense(ti.i, n + 1).place(self.offsets)
+            builder.dense(ti.i, m).place(self.neighbors, self.probs)
+            builder.dense(ti.i, max(n, 1)).place(self.removed)
+            self.tree = builder.finalize()
+
+            self.offsets.from_numpy(np.asarray(graph.offsets).astype(np.int32))
+            if len(graph.neighbors) > 0:
+                self.neighbors.from_numpy(np.asarray(graph.neighbors))
+            self.load_probs(graph)
+
+        def holds(self, graph: SparseGraph) -> bool:
+            return all(a is b for a, b in zip(self.arrays, (graph.offsets, graph.neighbors, graph.probs)))
+
+        def load_probs(self, graph: SparseGraph):
+            if len(graph.probs) > 0:
+                self.probs.from_numpy(np.asarray(graph.probs))
+
+        def load_mask(self, graph: SparseGraph):
+            self.pending = []
+            if len(graph) > 0:
+                self.removed.from_numpy(np.frombuffer(graph.removed, dtype=np.uint8))
+
+        def remove_vertex(self, v: int):
+            # writing a field from python costs about as much as a kernel launch, so the
+            # removals wait for the next launch
+            self.pending.append(v)
+
+        def destroy(self):
+            self.tree.destroy()
+
+        def cal_probs(self, vertexes: List[int], k: int) -> List[float]:
+            """UCO.cal_probs on the fields"""
+            if len(vertexes) == 0:
+                return []
+            frontier = np.asarray(vertexes, dtype=np.int32)
+            removed = np.asarray(self.pending, dtype=np.int32)
+            self.pending = []
+            dist = np.empty((len(frontier), k))
+            res = np.empty(len(frontier))
+            self.frontier_probs(removed, frontier, k, dist, res)
+            return res.tolist()
+
+        @ti.kernel
+        def frontier_probs(self, removed: ti.types.ndarray(dtype=ti.i32, ndim=1),
+                           frontier: ti.types.ndarray(dtype=ti.i32, ndim=1), k: ti.i32,
+                           dist: ti.types.ndarray(dtype=ti.f64, ndim=2),
+                           res: ti.types.ndarray(dtype=ti.f64, ndim=1)):
+            # the outermost loops run one after the other, each of them in parallel
+            for i in range(removed.shape[0]):
+                self.removed[removed[i]] = ti.u8(1)
+            for i in range(frontier.shape[0]):
+                v = frontier[i]
+                dist[i, 0] = 1.0
+                for j in range(1, k):
+                    dist[i, j] = 0.0
+                for e in range(self.offsets[v], self.offsets[v + 1]):
+                    p = self.probs[e]
+                    if self.removed[self.neighbors[e]] == 0 and p != 0:
+                        q = 1 - p
+                        for h in range(k - 1):
+                            j = k - 1 - h
+                            dist[i, j] = p * dist[i, j - 1] + q * dist[i, j]
+                        dist[i, 0] = q * dist[i, 0]
+
+                prob = 1.0
+                for j in range(k):
+                    prob = prob - dist[i, j]
+                res[i] = prob
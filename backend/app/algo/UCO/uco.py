@@ -1,108 +1,411 @@
-from typing import List
-import copy
-from functools import lru_cache
+import logging
+import math
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
 
 import app.algo.heap as heap
 from app.algo.decorate import wrapper
+from app.algo.sparse_graph import SparseGraph, as_sparse_graph
+
+
+CUT_OFF = 0.001
+# 'taichi' needs taichi_backend.available()
+BACKENDS = ('python', 'taichi')
+
+
+class PruningStats:
+    """
+    counts the vertexes that prune dropped before any k-prob was calculated for them,
+    every one of them saves at least one evaluation of the DP
+    """
+    core: int
+    bound: int
+    evaluated: int
+    extended: int
+
+    def __init__(self):
+        self.core = 0
+        self.bound = 0
+        self.evaluated = 0
+        self.extended = 0
+
+    def merge(self, other: 'PruningStats'):
+        self.core += other.core
+        self.bound += other.bound
+        self.evaluated += other.evaluated
+        self.extended += other.extended
+
+    def avoided(self) -> int:
+        return self.core + self.bound
+
+    def __str__(self):
+        return f'{self.avoided()} dp evaluations avoided (core {self.core}, bound {self.bound}), ' \
+               f'{self.evaluated} evaluated, {self.extended} extended from the previous k'
 
 
 @wrapper
-def UCO_Index(graph: List[List[float]], filename: str = 'default'):
-    vertex_num = len(graph)
-    order = [[] for _ in range(vertex_num)]
+def UCO_Index(graph: SparseGraph, filename: str = 'default', stats: PruningStats = None, multi_k: bool = True,
+              backend: str = 'python'):
+    """
+    the thresholds of every vertex for k = 1, 2, ... until no vertex passes CUT_OFF
+    :param graph: not changed
+    :param filename: used by the log
+    :param stats: count the pruned vertexes and the DP evaluations
+    :param multi_k: peel k + 1 on the survivors of k only, and extend the DP tables of the
+        previous k instead of running the DP again. a vertex whose k-threshold is not above
+        CUT_OFF can not pass it for k + 1, so the order is the same as without it
+    :param backend: one of BACKENDS, where the k-probs are calculated while peeling. with
+        'taichi' the k-probs of every level are taken by one launch of the kernel instead of
+        extending the DP tables, which is where the kernel pays off
+    :return: order, order[v][k - 1] is the threshold of v for k
+    """
+    graph = as_sparse_graph(graph)
+    order = [[] for _ in range(len(graph))]
+    stats = stats if stats is not None else PruningStats()
+    for _, level in peel_levels(graph, stats=stats, multi_k=multi_k, backend=backend):
+        for u, cur_thres in level:
+            order[u].append(cur_thres)
 
-    k = 0
-    is_end = False
-    while not is_end:
+    logging.info('UCO_Index of %s: %s', filename, stats)
+    return order
+
+
+def peel_levels(graph: SparseGraph, first_level: int = 1, survivors: List[int] = None,
+                stats: PruningStats = None, multi_k: bool = True,
+                backend: str = 'python') -> Iterator[Tuple[int, List[Tuple[int, float]]]]:
+    """
+    the levels of UCO_Index from first_level up, until no vertex passes CUT_OFF
+    :param survivors: the vertexes which passed CUT_OFF for first_level - 1, every vertex by default
+    :return: yield (k, [(vertex, threshold)]) of the vertexes passing CUT_OFF for k, in the order of removal
+    """
+    # the first k-probs of a level are the biggest frontier, the kernel takes them on taichi
+    tables = DistributionTables(len(graph)) if multi_k and backend == 'python' else None
+    k = first_level
+    while True:
+        temp_map = graph.copy() if survivors is None else graph.restrict(survivors)
+        vertexes = prune(temp_map, k, stats=stats)
+        k_probs = tables.k_probs(temp_map, vertexes, k, stats) if tables is not None else None
+
+        level = [(u, cur_thres) for u, cur_thres in peel(temp_map, k, vertexes, stats, k_probs, backend)
+                 if cur_thres > CUT_OFF]
+        if not level:
+            return
+        yield k, level
+        survivors = [u for u, _ in level] if multi_k else None
         k += 1
-        is_end = True
-        temp_map = copy.deepcopy(graph)
-        cur_thres = 0
-        vertex_set = set(range(len(temp_map)))
-
-        k_probs = [cal_prob(temp_map, index, k) for index in vertex_set]
-        probs_index = [[prob, i] for i, prob in enumerate(k_probs)]
-        heaps = heap.Heap(probs_index, compare=lambda a, b: a[0] > b[0])
-        heaps.heapify()
-
-        while not graph_is_empty(temp_map):
-            u = heaps.heap_pop()
-            cur_thres = max(cur_thres, u[0])
-            if cur_thres > 0.001:
-                is_end = False
-                order[u[1]].append(cur_thres)
-
-            # remove v from vertex set
-            vertex_set.remove(u[1])
-            for i, neighbor in enumerate(temp_map[u[1]]):
-                if neighbor != 0:
-                    # remove neighbor edge from map
-                    remove_edge_from_graph(temp_map, u[1], i)
-
-                    # update k probs
-
-                    k_probs = [cal_prob(temp_map, index, k) for index in vertex_set]
-                    probs_index = [[prob, i] for i, prob in zip(vertex_set, k_probs)]
-                    heaps = heap.Heap(probs_index, compare=lambda a, b: a[0] > b[0])
-                    heaps.heapify()
 
-    return order
+
+def live_vertexes(graph: SparseGraph) -> List[int]:
+    """the vertexes which are not removed and own an edge"""
+    return [v for v in range(len(graph)) if not graph.is_removed(v) and graph.has_edges(v)]
+
+
+def prune(graph: SparseGraph, k: int, vertexes: Iterable[int] = None, cut_off: float = CUT_OFF,
+          stats: PruningStats = None) -> List[int]:
+    """
+    remove the vertexes whose k-prob can not exceed cut_off before peeling:
+    those left with less than k neighbors, i.e. out of the k-core, and those whose
+    prob_upper_bound is below cut_off. removing a vertex lowers the bounds of its neighbors,
+    so the check is propagated until nothing changes.
+    the thresholds above cut_off are the same with or without the pruned vertexes, since
+    those are peeled before cur_thres can pass cut_off anyway.
+    :param graph: the pruned vertexes are removed from it
+    :param k: k number
+    :param vertexes: the candidates, every vertex owning an edge by default
+    :param cut_off: the smallest threshold that matters
+    :param stats: count the pruned vertexes
+    :return: the vertexes left to peel
+    """
+    if vertexes is None:
+        vertexes = live_vertexes(graph)
+
+    degree, mass = {}, {}
+    for v in vertexes:
+        probs = graph.neighbor_probs(v)
+        degree[v], mass[v] = len(probs), sum(probs)
+
+    def can_prune(v):
+        # leave some room for the rounding error of the running sums
+        return degree[v] < k or prob_upper_bound(mass[v], k) < cut_off * (1 - 1e-9)
+
+    queue = [v for v in degree if can_prune(v)]
+    pruned = set(queue)
+    while len(queue) != 0:
+        v = queue.pop()
+        if stats is not None:
+            if degree[v] < k:
+                stats.core += 1
+            else:
+                stats.bound += 1
+        graph.remove_vertex(v)
+        for u, p in graph.neighbor_items(v):
+            if u in degree and u not in pruned:
+                degree[u] -= 1
+                mass[u] -= p
+                if can_prune(u):
+                    pruned.add(u)
+                    queue.append(u)
+
+    return [v for v in degree if v not in pruned]
+
+
+def prob_upper_bound(mass: float, k: int) -> float:
+    """
+    upper bound of P(deg >= k) from the sum of the edge probs: Markov gives mass / k, and the
+    union bound over the k-subsets of edges gives e_k(p) <= mass^k / k!
+    :param mass: the sum of the edge probs of the vertex
+    :param k: k number
+    :return: the bound
+    """
+    if mass <= 0:
+        return .0
+    return min(mass / k, math.exp(min(k * math.log(mass) - math.lgamma(k + 1), .0)))
+
+
+def peel(graph: SparseGraph, k: int, vertexes: Iterable[int] = None,
+         stats: PruningStats = None, k_probs: List[float] = None,
+         backend: str = 'python', anchors: Dict[int, float] = None) -> Iterator[Tuple[int, float]]:
+    """
+    remove the vertex with the smallest k-prob one by one. when a vertex is removed only the
+    k-probs of its neighbors change, so only their keys are updated in the heap.
+    :param graph: the vertexes are removed from it while peeling
+    :param k: k number
+    :param vertexes: the vertexes to peel, every vertex owning an edge by default
+    :param stats: count the k-prob evaluations
+    :param k_probs: the current k-probs of vertexes if they are known already
+    :param backend: one of BACKENDS, where the k-probs of the frontiers are calculated
+    :param anchors: vertexes around vertexes whose thresholds are known and fixed, {vertex: threshold}.
+        an anchor is removed when cur_thres reaches its threshold, as the peeling of the whole graph
+        would do, so the thresholds of vertexes are the same as there. anchors are not yielded
+    :return: yield (vertex, cur_thres) in the order of removal
+    """
+    assert backend in BACKENDS, f"unknown backend {backend}"
+    if vertexes is None:
+        vertexes = live_vertexes(graph)
+
+    fields = None
+    if backend == 'taichi':
+        # taichi is heavy to import and optional, only load it when asked for
+        from app.algo.UCO import taichi_backend
+        fields = taichi_backend.frontier_of(graph)
+
+    def frontier_probs(frontier):
+        if fields is not None and len(frontier) >= BATCH_SIZE:
+            return fields.cal_probs(frontier, k)
+        return cal_probs(graph, frontier, k)
+
+    vertexes = list(vertexes)
+    if k_probs is None:
+        k_probs = frontier_probs(vertexes)
+        if stats is not None:
+            stats.evaluated += len(vertexes)
+    heaps = heap.IndexedHeap(len(graph), zip(vertexes, k_probs))
+    anchors = anchors if anchors is not None else {}
+    for a, thres in anchors.items():
+        heaps.push(a, thres)
+
+    cur_thres = 0
+    while len(heaps) != 0:
+        u, prob = heaps.pop()
+        cur_thres = max(cur_thres, prob)
+        graph.remove_vertex(u)
+        if fields is not None:
+            fields.remove_vertex(u)
+        if u not in anchors:
+            yield u, cur_thres
+
+        # update k probs of the neighbors only
+        frontier = [v for v in graph.neighbors_of(u) if v in heaps and v not in anchors]
+        for v, prob in zip(frontier, frontier_probs(frontier)):
+            heaps.update(v, prob)
+        if stats is not None:
+            stats.evaluated += len(frontier)
+
+
+def cal_prob(graph: SparseGraph, index: int, k: int) -> float:
+    return prob_from_distribution(degree_distribution(graph.neighbor_probs(index), k), k)
+
+
+def cal_prob_equal(graph: SparseGraph, index: int, k: int) -> float:
+    """
+    cal prob of index in new graph
+    :param graph: will change when vertex removal
+    :param index: the index of vertex
+    :param k: k number
+    :return: the prob that the degree of index is exactly k
+    """
+    return degree_distribution(graph.neighbor_probs(index), k + 1)[k]
 
 
-def cal_prob(graph: List[List[float]], index: int, k: int) -> float:
+def degree_distribution(edges: List[float], k: int) -> List[float]:
+    """
+    cal X(h, j) = p_h * X(h - 1, j - 1) + (1 - p_h) * X(h - 1, j) iteratively, one row per edge
+    :param edges: the probs of the edges of the vertex
+    :param k: k number
+    :return: [P(deg = 0), ..., P(deg = k - 1)]
+    """
+    dist = [1.0] + [.0] * (k - 1)
+    for p in edges:
+        q = 1 - p
+        for j in range(k - 1, 0, -1):
+            dist[j] = p * dist[j - 1] + q * dist[j]
+        dist[0] = q * dist[0]
+
+    return dist
+
+
+def prob_from_distribution(dist, k: int):
+    """
+    P(deg >= k) = 1 - P(deg = 0) - ... - P(deg = k - 1), works on numpy columns as well
+    """
     res = 1
     for i in range(0, k):
-        res -= cal_prob_equal(graph, index, i)
+        res = res - dist[i]
 
     return res
 
 
-def cal_prob_equal(graph: List[List[float]], index: int, k: int) -> float:
+def batch_degree_distribution(edges: np.ndarray, k: int, keep_column: bool = False):
     """
-    cal prob of index in new graph
-    :param graph: will change when edge removal
-    :param index: the index of vertex
+    degree_distribution for many vertexes at once
+    :param edges: (vertex_num, max_degree) edge probs, padded with 0 which leaves the result unchanged
     :param k: k number
-    :return: the k-prob of vertex index
-    """
-    edges = []
-
-    # find neighbors of index
-    for i, m in enumerate(graph):
-        if m[index] != 0:
-            edges.append(i)
-
-    # print(edges)
-    @lru_cache(maxsize=None)
-    def X(h, j) -> float:
-        """
-        cal prob X(h, j)
-        :param h: the len of edges
-        :param j: the num of degree we suppose
-        :return: the prob
-        """
-        if j == -1:
-            return 0
-        elif h == 0 and j == 0:
-            return 1
-        elif h <= len(edges) and h + 1 <= j <= k:
-            return 0
-        return graph[index][edges[h - 1]] * X(h - 1, j - 1) + (1 - graph[index][edges[h - 1]]) * X(h - 1, j)
-
-    return X(len(edges), k)
-
-
-def graph_is_empty(graph: List[List[float]]) -> bool:
-    for i in graph:
-        for j in i:
-            if j != 0:
-                return False
-    return True
-
-
-def remove_edge_from_graph(graph: List[List[float]], x: int, y: int):
-    graph[x][y] = .0
-    # graph[y][x] = .0
+    :param keep_column: return the column X(., k - 1) as well, see batch_extend_column
+    :return: (k, vertex_num), row j is P(deg = j) of every vertex
+    """
+    dist = np.zeros((k, edges.shape[0]))
+    dist[0] = 1.0
+    column = np.empty((edges.shape[0], edges.shape[1] + 1)) if keep_column else None
+    if keep_column:
+        column[:, 0] = dist[k - 1]
+    for h in range(edges.shape[1]):
+        p = edges[:, h]
+        q = 1 - p
+        dist[1:] = p * dist[:-1] + q * dist[1:]
+        dist[0] = q * dist[0]
+        if keep_column:
+            column[:, h + 1] = dist[k - 1]
+
+    return (dist, column) if keep_column else dist
+
+
+def batch_extend_column(edges: np.ndarray, column: np.ndarray) -> np.ndarray:
+    """
+    the column X(., j) from the column X(., j - 1) for many vertexes,
+    X(h, j) = p_h * X(h - 1, j - 1) + (1 - p_h) * X(h - 1, j)
+    :param edges: (vertex_num, max_degree) edge probs padded with 0
+    :param column: (vertex_num, max_degree + 1), X(0, j - 1), ..., X(max_degree, j - 1)
+    :return: X(0, j), ..., X(max_degree, j), the last one is P(deg = j)
+    """
+    res = np.zeros(column.shape)
+    for h in range(edges.shape[1]):
+        p = edges[:, h]
+        res[:, h + 1] = p * column[:, h] + (1 - p) * res[:, h]
+
+    return res
+
+
+class DistributionTables:
+    """
+    the DP of every vertex kept from one k to the next: the column X(., k - 1) over its CSR row
+    and P(deg = 0), ..., P(deg = k - 1), taken over the live neighbors when the level started.
+    the live neighbors only shrink from one level to the next, so when their number did not
+    change the table is extended by one column in O(deg) instead of running the DP again.
+    """
+    columns: list
+    dists: list
+    degrees: list
+
+    def __init__(self, vertex_num: int):
+        self.columns = [None for _ in range(vertex_num)]
+        self.dists = [None for _ in range(vertex_num)]
+        self.degrees = [0 for _ in range(vertex_num)]
+
+    def k_probs(self, graph: SparseGraph, vertexes: List[int], k: int, stats: PruningStats = None) -> List[float]:
+        vertexes = np.asarray(vertexes, dtype=np.int64)
+        res = np.zeros(len(vertexes))
+        for group, members, edges in degree_groups(graph, vertexes):
+            group_vertexes = vertexes[members].tolist()
+            degree = np.count_nonzero(edges, axis=1).tolist()
+            width = edges.shape[1] + 1
+
+            reuse = np.array([self.dists[v] is not None and len(self.dists[v]) == k - 1 and self.degrees[v] == d
+                              for v, d in zip(group_vertexes, degree)], dtype=bool)
+            dist = np.empty((len(members), k))
+            column = np.empty((len(members), width))
+            if reuse.any():
+                reused = [v for v, r in zip(group_vertexes, reuse) if r]
+                old = np.stack([self.columns[v] for v in reused])[:, :width]
+                column[reuse] = batch_extend_column(edges[reuse], old)
+                dist[reuse, :k - 1] = np.stack([self.dists[v] for v in reused])
+                dist[reuse, k - 1] = column[reuse, -1]
+            fresh = ~reuse
+            if fresh.any():
+                fresh_dist, column[fresh] = batch_degree_distribution(edges[fresh], k, keep_column=True)
+                dist[fresh] = fresh_dist.T
+            if stats is not None:
+                stats.extended += int(reuse.sum())
+                stats.evaluated += int(fresh.sum())
+
+            res[members] = prob_from_distribution(dist.T, k)
+            # the columns of a group are kept 2 ** group long, the padding leaves them constant
+            column = np.pad(column, ((0, 0), (0, (1 << int(group)) - width)), mode='edge')
+            for i, v in enumerate(group_vertexes):
+                self.columns[v] = column[i]
+                self.dists[v] = dist[i]
+                self.degrees[v] = degree[i]
+
+        return res.tolist()
+
+
+def neighbor_prob_matrix(graph: SparseGraph, vertexes: np.ndarray) -> np.ndarray:
+    """
+    the edge probs of vertexes gathered straight from the CSR arrays, one row per vertex.
+    removed neighbors and the padding get prob 0, which leaves the distribution unchanged
+    """
+    offsets = np.asarray(graph.offsets)
+    starts = offsets[vertexes]
+    degree = offsets[vertexes + 1] - starts
+    columns = np.arange(degree.max(initial=0))
+    valid = columns < degree[:, None]
+    position = np.where(valid, starts[:, None] + columns, 0)
+
+    neighbors = np.asarray(graph.neighbors)[position]
+    alive = np.frombuffer(graph.removed, dtype=np.uint8)[neighbors] == 0
+    return np.where(valid & alive, np.asarray(graph.probs)[position], .0)
+
+
+def degree_groups(graph: SparseGraph, vertexes: np.ndarray):
+    """
+    vertexes grouped by the bit length of their CSR row, so that the padding of the matrix of a
+    group stays below half of it. cal_probs and DistributionTables run the DP of a group at once
+    :return: yield (bit length, the positions of the group in vertexes, neighbor_prob_matrix of the group)
+    """
+    offsets = np.asarray(graph.offsets)
+    groups = np.frexp(offsets[vertexes + 1] - offsets[vertexes])[1]
+    for group in np.unique(groups):
+        members = np.nonzero(groups == group)[0]
+        yield group, members, neighbor_prob_matrix(graph, vertexes[members])
+
+
+BATCH_SIZE = 64
+
+
+def cal_probs(graph: SparseGraph, vertexes: List[int], k: int) -> List[float]:
+    """
+    cal_prob for a frontier of vertexes. big frontiers are grouped by degree so that the padding
+    stays small, and every group is evaluated with one call of batch_degree_distribution
+    """
+    if len(vertexes) < BATCH_SIZE:
+        return [cal_prob(graph, v, k) for v in vertexes]
+
+    vertexes = np.asarray(vertexes, dtype=np.int64)
+    res = np.zeros(len(vertexes))
+    for _, members, edges in degree_groups(graph, vertexes):
+        res[members] = prob_from_distribution(batch_degree_distribution(edges, k), k)
+
+    return res.tolist()
 
 
 def print_res(index: List[List[int]]):
@@ -0,0 +1,228 @@
+"""
+benchmarks of the index algorithms on random graphs.
+run `python -m app.algo.benchmark [name ...]` from the backend directory.
+"""
+import contextlib
+import io
+import copy
+import os
+import random
+import sys
+import tempfile
+import time
+from itertools import islice
+
+from app.algo import heap
+from app.algo.UCO import uco as UCO
+from app.algo.UCO import parallel
+from app.algo.UCO import taichi_backend
+from app.algo.maintenance import maintenance
+from app.algo.maintenance import parallel as parallel_maintenance
+from app.algo.sparse_graph import SparseGraph
+from app.utils.graph_parser import generate_random_graph, read_graph_file, write_graph_file
+from app.utils.graph_snapshot import load_snapshot, snapshot_path
+
+
+def timing(func, *args, **kwargs):
+    start_time = time.time()
+    res = func(*args, **kwargs)
+    return res, time.time() - start_time
+
+
+def peel_by_rebuild(graph: SparseGraph, k: int, steps: int = None):
+    """
+    the peeling used before UCO.peel, every removal recalculates the k-prob of all the
+    remaining vertexes and rebuilds the heap
+    :param steps: stop after this many removals, it is O(n ^ 2) in total
+    """
+    vertex_set = set(v for v in range(len(graph)) if graph.has_edges(v))
+    probs_index = [[UCO.cal_prob(graph, v, k), v] for v in vertex_set]
+    heaps = heap.Heap(probs_index, compare=lambda a, b: a[0] > b[0])
+    heaps.heapify()
+
+    res, cur_thres = [], 0
+    while vertex_set and (steps is None or len(res) < steps):
+        prob, u = heaps.heap_pop()
+        cur_thres = max(cur_thres, prob)
+        res.append((u, cur_thres))
+
+        vertex_set.remove(u)
+        graph.remove_vertex(u)
+        probs_index = [[UCO.cal_prob(graph, v, k), v] for v in vertex_set]
+        heaps = heap.Heap(probs_index, compare=lambda a, b: a[0] > b[0])
+        heaps.heapify()
+
+    return res
+
+
+def bench_peeling(sizes=(250, 500, 1000, 10000, 20000, 100000), k=2, avg_degree=8, rebuild_limit=1000,
+                  rebuild_steps=100):
+    """
+    incremental peeling against rebuilding the heap after every removal. a whole rebuild peeling
+    takes hours above rebuild_limit, so both are timed on the first rebuild_steps removals there
+    """
+    for n in sizes:
+        graph = generate_random_graph(n, avg_degree, seed=n)
+        res, cost = timing(lambda: list(UCO.peel(graph.copy(), k)))
+        line = f'peeling n={n} m={graph.edge_num()} k={k}: incremental {cost:.3f}s'
+        if n <= rebuild_limit:
+            old_res, old_cost = timing(peel_by_rebuild, graph.copy(), k)
+            assert sorted(res) == sorted(old_res), "incremental peeling changed the thresholds"
+            line += f', rebuild {old_cost:.3f}s'
+        else:
+            res, cost = timing(lambda: list(islice(UCO.peel(graph.copy(), k), rebuild_steps)))
+            old_res, old_cost = timing(peel_by_rebuild, graph.copy(), k, rebuild_steps)
+            assert [t for _, t in res] == [t for _, t in old_res], "incremental peeling changed the thresholds"
+            line += f', first {rebuild_steps} removals: incremental {cost:.3f}s, rebuild {old_cost:.3f}s'
+        print(line)
+
+
+def bench_distribution(n=20000, avg_degree=16, ks=(2, 5, 10)):
+    """one k-prob per vertex against the degree-grouped numpy batch"""
+    graph = generate_random_graph(n, avg_degree, seed=n)
+    vertexes = list(range(n))
+    for k in ks:
+        res, cost = timing(lambda: [UCO.cal_prob(graph, v, k) for v in vertexes])
+        batch_res, batch_cost = timing(UCO.cal_probs, graph, vertexes, k)
+        assert res == batch_res, "batch k-probs differ from the single vertex ones"
+        print(f'distribution n={n} k={k}: per vertex {cost:.3f}s, batch {batch_cost:.3f}s')
+
+
+def bench_parallel(n=20000, avg_degree=8, workers=(1, 2, 4, 8, 16, 32)):
+    """UCO_Index against the (k, component) units peeled by worker processes"""
+    graph = generate_random_graph(n, avg_degree, seed=n)
+    with contextlib.redirect_stdout(io.StringIO()):
+        res, cost = timing(UCO.UCO_Index, graph)
+    print(f'index n={n} m={graph.edge_num()}: UCO_Index {cost:.3f}s')
+    for w in workers:
+        if w > (os.cpu_count() or 1):
+            break
+        with contextlib.redirect_stdout(io.StringIO()):
+            parallel_res, parallel_cost = timing(parallel.parallel_UCO_Index, graph, workers=w)
+        assert res == parallel_res, "the parallel index differs from UCO_Index"
+        print(f'index n={n}: parallel_UCO_Index with {w} workers {parallel_cost:.3f}s')
+
+
+def bench_taichi(n=20000, avg_degree=16, ks=(2, 5, 10)):
+    """the numpy batch against the taichi kernel, for one frontier and for the whole index"""
+    if not taichi_backend.available():
+        print('taichi is not installed')
+        return
+    graph = generate_random_graph(n, avg_degree, seed=n)
+    vertexes = list(range(n))
+    fields = taichi_backend.frontier_of(graph)
+    fields.cal_probs(vertexes[:1], 2)  # compile the kernel
+    for k in ks:
+        res, cost = timing(UCO.cal_probs, graph, vertexes, k)
+        taichi_res, taichi_cost = timing(fields.cal_probs, vertexes, k)
+        assert max(abs(a - b) for a, b in zip(res, taichi_res)) < 1e-12, "taichi k-probs differ"
+        print(f'frontier n={n} k={k}: numpy {cost:.3f}s, taichi {taichi_cost:.3f}s')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        res, cost = timing(UCO.UCO_Index, graph)
+        taichi_res, taichi_cost = timing(UCO.UCO_Index, graph, backend='taichi')
+    assert res == taichi_res, "the taichi index differs"
+    print(f'index n={n}: python {cost:.3f}s, taichi {taichi_cost:.3f}s')
+
+
+def random_updates(graph: SparseGraph, count: int, seed: int, decrease_share: float = .0):
+    """
+    (u, v, new_p) of count random edges. decrease_share of them lower the prob of an edge, a quarter
+    of those delete it, the others raise the prob of an edge, half of them new
+    """
+    rand = random.Random(seed)
+    edges = list(graph.edges())
+    updates = []
+    while len(updates) < count:
+        if rand.random() < decrease_share:
+            u, v, p = rand.choice(edges)
+            updates.append((u, v, 0 if rand.random() < .25 else rand.uniform(0, p)))
+            continue
+        if rand.random() < .5:
+            u, v, p = rand.choice(edges)
+        else:
+            u, v = rand.sample(range(len(graph)), 2)
+            p = graph.get_prob(u, v)
+        updates.append((u, v, rand.uniform(p, 1)))
+    return updates
+
+
+def bench_maintenance(n=5000, avg_degree=8, batches=(1, 10, 100), single_limit=10,
+                      decrease_shares=(.0, 1., .5)):
+    """
+    batch_core_maintenance against one update at a time and against rebuilding UCO_Index, for
+    increases, decreases and mixed batches
+    """
+    graph = generate_random_graph(n, avg_degree, seed=n)
+    with contextlib.redirect_stdout(io.StringIO()):
+        order = UCO.UCO_Index(graph)
+    for share in decrease_shares:
+        for count in batches:
+            updates = random_updates(graph, count, seed=count, decrease_share=share)
+            with contextlib.redirect_stdout(io.StringIO()):
+                batch_graph, batch_order = copy.deepcopy(graph), copy.deepcopy(order)
+                _, batch_cost = timing(maintenance.batch_core_maintenance, batch_graph, batch_order, updates)
+                res, cost = timing(UCO.UCO_Index, batch_graph)
+            assert batch_order == res, "the maintained index differs from UCO_Index"
+            line = f'maintenance n={n} updates={count} decreases={share:.0%}: batch {batch_cost:.3f}s, ' \
+                   f'UCO_Index {cost:.3f}s'
+
+            if count <= single_limit:
+                single_graph, single_order = copy.deepcopy(graph), copy.deepcopy(order)
+                start_time = time.time()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for update in updates:
+                        maintenance.batch_core_maintenance(single_graph, single_order, [update])
+                assert single_order == res, "the maintained index differs from UCO_Index"
+                line += f', one by one {time.time() - start_time:.3f}s'
+            print(line)
+
+
+def bench_parallel_maintenance(n=5000, avg_degree=8, count=10, workers=(1, 2, 4, 8, 16, 32)):
+    """batch_core_maintenance against the levels maintained by worker processes"""
+    graph = generate_random_graph(n, avg_degree, seed=n)
+    with contextlib.redirect_stdout(io.StringIO()):
+        order = UCO.UCO_Index(graph)
+    updates = random_updates(graph, count, seed=count, decrease_share=.5)
+    with contextlib.redirect_stdout(io.StringIO()):
+        res, cost = timing(maintenance.batch_core_maintenance, copy.deepcopy(graph), copy.deepcopy(order), updates)
+    print(f'maintenance n={n} updates={count} k_max={max(map(len, order))}: sequential {cost:.3f}s')
+    for w in workers:
+        if w > (os.cpu_count() or 1):
+            break
+        with contextlib.redirect_stdout(io.StringIO()):
+            parallel_res, parallel_cost = timing(parallel_maintenance.parallel_batch_core_maintenance,
+                                                 copy.deepcopy(graph), copy.deepcopy(order), updates, workers=w)
+        assert res == parallel_res, "the parallel maintenance differs"
+        print(f'maintenance n={n}: {w} workers {parallel_cost:.3f}s')
+
+
+def bench_graph_load(sizes=(10000, 100000, 1000000), avg_degree=8, repeat=3):
+    """read_graph_file of the text file against mapping its snapshot"""
+    with tempfile.TemporaryDirectory() as folder:
+        for n in sizes:
+            path = os.path.join(folder, f'{n}.graph')
+            write_graph_file(path, generate_random_graph(n, avg_degree, seed=n))
+            snapshot_cost = min(timing(load_snapshot, path)[1] for _ in range(repeat))
+            snapshot = load_snapshot(path)
+            os.remove(snapshot_path(path))
+            text_cost = min(timing(read_graph_file, path)[1] for _ in range(repeat))
+            text = read_graph_file(path)
+            assert list(snapshot.neighbors) == list(text.neighbors) and list(snapshot.probs) == list(text.probs)
+            print(f'load n={n} m={text.edge_num()}: text {text_cost:.3f}s, snapshot {snapshot_cost * 1000:.2f}ms')
+
+
+BENCHMARKS = {
+    'peeling': bench_peeling,
+    'distribution': bench_distribution,
+    'parallel': bench_parallel,
+    'taichi': bench_taichi,
+    'maintenance': bench_maintenance,
+    'parallel_maintenance': bench_parallel_maintenance,
+    'graph_load': bench_graph_load,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        BENCHMARKS[name]()
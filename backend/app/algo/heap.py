@@ -1,3 +1,7 @@
+from array import array
+from typing import Iterable, Tuple
+
+
 def default_compare(x, y) -> bool:
     return x < y
 
@@ -38,8 +42,8 @@ class Heap:
     def heap_pop(self):
         assert self.length > 0, "heap is empty."
         res = self._get_top()
-        self.arr[0], self.arr[self.length - 1] = self.arr[self.length - 1], self.arr[0]
-        self.arr = self.arr[:self.length - 1]
+        self.arr[0] = self.arr[self.length - 1]
+        self.arr.pop()
         self.length -= 1
         self.heap_adjust(0)
         return res
@@ -61,6 +65,114 @@ class Heap:
         return self.arr[0]
 
 
+class IndexedHeap:
+    """
+    min heap of float keys addressed by id, the ids are integers in [0, capacity).
+    pos records where every id sits in the heap, so the key of an id can be changed
+    or the id can be removed in O(log n) without searching the heap.
+    """
+    heap: list
+    keys: array
+    pos: array
+
+    def __init__(self, capacity: int, items: Iterable[Tuple[int, float]] = ()):
+        self.heap = []
+        self.keys = array('d', [.0]) * capacity
+        self.pos = array('l', [-1]) * capacity
+        for i, key in items:
+            self.pos[i] = len(self.heap)
+            self.keys[i] = key
+            self.heap.append(i)
+
+        for index in range((len(self.heap) - 2) // 2, -1, -1):
+            self._sift_down(index)
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def __contains__(self, i: int) -> bool:
+        return self.pos[i] != -1
+
+    def key(self, i: int) -> float:
+        return self.keys[i]
+
+    def peek(self) -> Tuple[int, float]:
+        assert len(self.heap) > 0, "heap is empty."
+        return self.heap[0], self.keys[self.heap[0]]
+
+    def push(self, i: int, key: float):
+        assert self.pos[i] == -1, "id is already in the heap."
+        self.keys[i] = key
+        self.pos[i] = len(self.heap)
+        self.heap.append(i)
+        self._sift_up(len(self.heap) - 1)
+
+    def pop(self) -> Tuple[int, float]:
+        assert len(self.heap) > 0, "heap is empty."
+        top = self.heap[0]
+        self._delete_at(0)
+        return top, self.keys[top]
+
+    def update(self, i: int, key: float):
+        """decrease or increase the key of i, push i if it is not in the heap"""
+        index = self.pos[i]
+        if index == -1:
+            self.push(i, key)
+            return
+        old_key = self.keys[i]
+        self.keys[i] = key
+        if key < old_key:
+            self._sift_up(index)
+        else:
+            self._sift_down(index)
+
+    def remove(self, i: int):
+        index = self.pos[i]
+        if index != -1:
+            self._delete_at(index)
+
+    def _delete_at(self, index: int):
+        removed, last = self.heap[index], self.heap.pop()
+        self.pos[removed] = -1
+        if index < len(self.heap):
+            self.heap[index] = last
+            self.pos[last] = index
+            self._sift_down(index)
+            self._sift_up(self.pos[last])
+
+    def _sift_up(self, index: int):
+        heap, keys, pos = self.heap, self.keys, self.pos
+        item = heap[index]
+        key = keys[item]
+        while index > 0:
+            parent = (index - 1) >> 1
+            if keys[heap[parent]] <= key:
+                break
+            heap[index] = heap[parent]
+            pos[heap[index]] = index
+            index = parent
+        heap[index] = item
+        pos[item] = index
+
+    def _sift_down(self, index: int):
+        heap, keys, pos = self.heap, self.keys, self.pos
+        length = len(heap)
+        item = heap[index]
+        key = keys[item]
+        child = 2 * index + 1
+        while child < length:
+            if child + 1 < length and keys[heap[child + 1]] < keys[heap[child]]:
+                child += 1
+            if key <= keys[heap[child]]:
+                break
+            heap[index] = heap[child]
+            pos[heap[index]] = index
+            index = child
+            child = 2 * index + 1
+        heap[index] = item
+        pos[item] = index
+
+
 # test
 if __name__ == "__main__":
     arr = [4, 9, 12, 232, 12, 8, 12, 25, 64, 34]
@@ -74,4 +186,9 @@ if __name__ == "__main__":
     print(heaps.heap_pop())
     print(heaps.heap_pop())
     print(heaps.heap_pop())
-    print(heaps.heap_pop())
\ No newline at end of file
+    print(heaps.heap_pop())
+
+    indexed = IndexedHeap(len(arr), enumerate(arr))
+    indexed.update(3, 1)
+    indexed.remove(0)
+    print([indexed.pop() for _ in range(len(indexed))])
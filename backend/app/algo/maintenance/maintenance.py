@@ -1,14 +1,23 @@
 import copy
+import logging
+import math
 import traceback
+from array import array
 from concurrent.futures import ProcessPoolExecutor
-from typing import List
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
 
 from app.algo.UCO import uco as UCO
-from app.algo import heap
+from app.algo.sparse_graph import SparseGraph
 from app.utils.graph_parser import pipeline_read_data
 from app.utils.graph_parser  import pipeline_change_map
 from app.algo.decorate import wrapper
 
+# a region holding more than this share of the vertexes is not re-peeled, the levels from its k up
+# are peeled again like UCO_Index does instead, which is cheaper than a region of most of the graph
+REBUILD_SHARE = .25
+
 
 class prob_of_vertex:
     prob: float
@@ -28,148 +37,310 @@ def prob_compare(v1: prob_of_vertex, v2: prob_of_vertex) -> bool:
     return v1.prob <= v2.prob
 
 
-"""
-when the prob of a edge (u, v) changes, we suppose k-prob(u) <= k-prob(v),
-recalculate the k-prob of u and maintain the upper bound, which is the max
-k-prob of the subset of changed vertex.
-"""
-
-
-def cal_k_probs_when_inserting(graph: List[List[float]], k_probs: List[List[float]], k: int, edge: List[int]):
-    """
-    cal new k-probs for special k
-    :param graph:
-    :param k_probs:
-    :param k:
-    :param edge:
-    :return:
-    """
-    probs = k_probs[k-1]
-
-    u = edge[1]
-    # we suppose k-prob(u) <= k-prob(v)
-    if probs[edge[0]] <= probs[edge[1]]:
-        u = edge[0]
-    if k > 2 and k_probs[k-2][u] < .001:
-        return probs
-
-    updating_vertexes = find_updating_vertex_when_inserting(u, graph, probs)
-    # delete edges
-    graph = delete_edges(graph, updating_vertexes)
-    temp_vertex = set(updating_vertexes)
-
-    updating_vertexes = [[vertex, False] for vertex in updating_vertexes]
-    # we suppose upper_bound is the new k-prob of u
-    upper_bound = probs[u] + .01
-    temp_k_probs = [UCO.cal_prob(graph, i[0], k) for i in updating_vertexes]
-
-    probs_index = [[prob, i[0]] for i, prob in zip(updating_vertexes, temp_k_probs)]
-    heaps = heap.Heap(probs_index, compare=lambda a, b: a[0] > b[0])
-    heaps.heapify()
-
-    # should use new judging condition
-    cur_thres = probs[u]
-    temp_map = copy.deepcopy(graph)
-    # vertex_set = set(updating_vertexes)
-    while not updating_ended(probs, updating_vertexes, upper_bound):
-        temp = heaps.heap_pop()
-
-        current_vertex = -1
-        for i, index in enumerate(updating_vertexes):
-            if index[0] == temp[1]:
-                current_vertex = i
-                updating_vertexes[i][1] = True
-                break
-
-        cur_thres = max(cur_thres, temp[0])
-
-        if cur_thres > .0001:
-            upper_bound = upper_bound_updating(upper_bound, cur_thres)
-            probs[updating_vertexes[current_vertex][0]] = cur_thres
-
-        temp_vertex.remove(temp[1])
-        for i, neighbor in enumerate(temp_map[temp[1]]):
-            if neighbor != 0:
-                UCO.remove_edge_from_graph(temp_map, temp[1], i)
-
-        # update k probs
-        k_probs = [UCO.cal_prob(temp_map, index, k) for index in temp_vertex]
-        probs_index = [[prob, i] for i, prob in zip(temp_vertex, k_probs)]
-        heaps = heap.Heap(probs_index, compare=lambda a, b: a[0] > b[0])
-        heaps.heapify()
-
-    return probs
-
-
-def find_updating_vertex_when_inserting(index_of_u: int, graph: List[List[float]], k_probs_of_vertexes: List[float]) -> List[int]:
-    """
-    use bfs to find which vertex should be updating, the lower_bound is k-probs of u when inserting
-    :param index_of_u:
-    :param graph:
-    :param k_probs_of_vertexes:
-    :return: updating vertex
-    """
-    visited = [False for _ in range(len(graph))]
-    visited[index_of_u] = True
-    queue = [index_of_u]
-    res = [index_of_u]
-    while len(queue) != 0:
-        temp = queue[0]
-        queue = queue[1:]
-        for index in find_neighbors(graph, temp):
-            if not visited[index] and k_probs_of_vertexes[index] >= k_probs_of_vertexes[index_of_u]:
-                visited[index] = True
-                queue.append(index)
-                res.append(index)
+def threshold_of(order: List[List[float]], v: int, k: int) -> float:
+    """the threshold of v for k in the order of UCO_Index, 0 if it does not pass CUT_OFF"""
+    return order[v][k - 1] if len(order[v]) >= k else .0
 
-    return res
 
+class RegionWorkspace:
+    """
+    the buffers of the region searches of one batch, allocated once instead of once per search.
+    a search marks the vertexes it reaches with an epoch of its own, so starting a new search is
+    O(1) instead of clearing a visited array, and the region found so far is the queue of the
+    search. relabel maps the vertexes of a local graph to their local ids, see
+    SparseGraph.induced_subgraph, it is -1 filled between the uses.
+    so a search costs the size of the region and of its border, not the size of the graph
+    """
+    epoch: array
+    current: int
+    relabel: np.ndarray
 
-def find_neighbors(graph: List[List[float]], index: int) -> List[int]:
-    res = []
-    for i, e in enumerate(graph[index]):
-        if i != index and e > 0:
-            res.append(i)
+    def __init__(self, vertex_num: int):
+        self.epoch = array('q', [0]) * vertex_num
+        self.current = 0
+        self.relabel = np.full(vertex_num, -1, dtype=np.int64)
+
+    def start(self) -> int:
+        """a new epoch, no vertex is marked with it yet"""
+        self.current += 1
+        return self.current
 
-    return res
 
+def old_threshold(order: List[List[float]], previous: Dict[int, List[float]], v: int, k: int) -> float:
+    """the k-threshold of v before the updates, previous keeps the rows which were cut since"""
+    return threshold_of(previous if v in previous else order, v, k)
 
-def updating_ended(k_probs: List[float], updating_vertex: List[int], upper_bound: float) -> bool:
+
+def decrease_region(graph: SparseGraph, order: List[List[float]], previous: Dict[int, List[float]], k: int,
+                    edges: List[Tuple[int, int]], workspace: RegionWorkspace) -> Tuple[List[int], int]:
     """
-    check whether all the updating vertex is updated
-    :param k_probs: the probs of k for each vertex
-    :param updating_vertex: vertex in updating
-    :param upper_bound: the change upper_bound probs
-    :return: True to end the while loop
+    the vertexes whose k-threshold may change when the probs of edges decrease.
+    for an edge (u, v) let r = min(t(u), t(v)): the (k, eta)-cores with eta > r do not hold both
+    u and v and do not change, so only the vertexes with t <= r may fall. a vertex w which falls
+    leaves the core of t(w) together with a set of vertexes with t >= t(w) connected to u or v,
+    and only the thresholds above CUT_OFF are kept, so the region is searched from the endpoints
+    through the vertexes with 0 < t <= r, with the largest r of the batch
+    :param graph: the graph after the updates
+    :param order: the thresholds of k are the old ones
+    :param previous: the rows cut on the lower levels, see old_threshold
+    :param k: k number
+    :param edges: the endpoints of the decreased edges
+    :param workspace: the vertexes of the region are marked with the epoch returned
+    :return: (region, epoch)
     """
-    for up in updating_vertex:
-        if up[1]:
-            continue
-        if k_probs[up[0]] < upper_bound:
-            return False
-    return True
+    epoch, marks = workspace.start(), workspace.epoch
+    region, upper = [], .0
+    for u, v in edges:
+        r = min(old_threshold(order, previous, u, k), old_threshold(order, previous, v, k))
+        if r > 0:
+            upper = max(upper, r)
+            for x in (u, v):
+                if marks[x] != epoch:
+                    marks[x] = epoch
+                    region.append(x)
+
+    head = 0
+    while head < len(region):
+        x = region[head]
+        head += 1
+        for y in graph.neighbors_of(x):
+            if marks[y] != epoch and 0 < old_threshold(order, previous, y, k) <= upper:
+                marks[y] = epoch
+                region.append(y)
+
+    return region, epoch
+
+
+def increase_region(graph: SparseGraph, order: List[List[float]], previous: Dict[int, List[float]], k: int,
+                    edges: List[Tuple[int, int]], workspace: RegionWorkspace, lowered: int = 0,
+                    lower_level: bool = True) -> List[int]:
+    """
+    the vertexes whose k-threshold may change when the probs of edges increase.
+    for an edge (u, v) let r = min(t(u), t(v)): the (k, eta)-cores with eta <= r hold both u and v
+    already and do not change, so only the vertexes with t >= r may rise. a vertex w which rises
+    to t'(w) joins the new core of t'(w) together with u and v, so t(w) < t'(w) <= min(t'(u), t'(v)),
+    which is bounded by the k-probs of u and v and by their thresholds of k - 1. every vertex which
+    rises is connected to u or v through vertexes which rise as well, and a vertex can not pass
+    CUT_OFF for k unless it passed it for k - 1, so the vertexes which did not are left out.
+    the vertexes risen by one edge may let another edge rise more, so the region of a batch is
+    searched from all the endpoints at once with the union of their ranges
+    :param graph: the graph after the updates
+    :param order: the thresholds of k are the old ones, those of k - 1 are up to date
+    :param previous: the rows cut on the lower levels, see old_threshold
+    :param k: k number
+    :param edges: the endpoints of the increased edges
+    :param workspace: the buffers of the search
+    :param lowered: the epoch of the region of the decreases of the same batch, applied before the
+        increases. the thresholds in it are not known, the search passes it and r of an endpoint
+        in it is 0
+    :param lower_level: whether the thresholds of k - 1 in order are up to date. if they are not,
+        e.g. when the levels are maintained at once, the k-probs take their place in the checks
+    :return: the region
+    """
+    marks = workspace.epoch
+
+    def allowed(x):
+        if k == 1:
+            return True
+        return len(order[x]) >= k - 1 if lower_level else UCO.cal_prob(graph, x, k) > UCO.CUT_OFF
+
+    def upper_bound(x):
+        bound = UCO.cal_prob(graph, x, k)
+        return min(bound, order[x][k - 2]) if k > 1 and lower_level else bound
+
+    def lower_bound(x):
+        return .0 if lowered and marks[x] == lowered else old_threshold(order, previous, x, k)
+
+    starts, lower, upper = [], math.inf, .0
+    for u, v in edges:
+        if allowed(u) and allowed(v):
+            edge_lower = min(lower_bound(u), lower_bound(v))
+            edge_upper = min(upper_bound(u), upper_bound(v))
+            # nothing rises above CUT_OFF unless both endpoints may, e.g. on a new level k_max + 1
+            if edge_lower < edge_upper and edge_upper > UCO.CUT_OFF:
+                starts.extend((u, v))
+                lower, upper = min(lower, edge_lower), max(upper, edge_upper)
+
+    # the marks of lowered are read before they are overwritten
+    epoch = workspace.start()
+    region = []
+    for x in starts:
+        if marks[x] != epoch:
+            marks[x] = epoch
+            region.append(x)
+
+    head = 0
+    while head < len(region):
+        x = region[head]
+        head += 1
+        for y in graph.neighbors_of(x):
+            if marks[y] != epoch and allowed(y) and \
+                    ((lowered and marks[y] == lowered) or lower <= old_threshold(order, previous, y, k) < upper):
+                marks[y] = epoch
+                region.append(y)
+
+    return region
+
+
+def repeel_region(graph: SparseGraph, order: List[List[float]], k: int, region: List[int],
+                  workspace: RegionWorkspace, stats: UCO.PruningStats = None) -> Dict[int, float]:
+    """
+    the new k-thresholds of region, the thresholds out of it do not change. the neighbors of region
+    are kept as anchors at their thresholds, and region and its anchors are peeled as a local graph
+    of their own, so the peeling costs the size of the region and not the size of graph
+    :param region: may hold a vertex twice
+    :return: {vertex: threshold}
+    """
+    marks = workspace.epoch
+    inside = workspace.start()
+    members = []
+    for x in region:
+        if marks[x] != inside:
+            marks[x] = inside
+            members.append(x)
+    region_size = len(members)
+
+    border = workspace.start()
+    anchors = {}
+    for x in members[:region_size]:
+        for y in graph.neighbors_of(x):
+            if marks[y] != inside and marks[y] != border:
+                marks[y] = border
+                members.append(y)
+                anchors[y] = threshold_of(order, y, k)
+
+    # the local graph numbers the members in ascending order, members[i] is local_id[i] in it
+    local = graph.induced_subgraph(members, workspace.relabel)
+    by_vertex = np.argsort(members)
+    local_id = np.empty(len(members), dtype=np.int64)
+    local_id[by_vertex] = np.arange(len(members))
+    local_id = local_id.tolist()
+    vertex_of = np.asarray(members)[by_vertex].tolist()
+    local_anchors = {local_id[i]: anchors[members[i]] for i in range(region_size, len(members))}
+
+    return {vertex_of[u]: thres
+            for u, thres in UCO.peel(local, k, local_id[:region_size], stats, anchors=local_anchors)}
+
+
+def too_large(region: List[int], vertex_num: int) -> bool:
+    """whether region, which may hold a vertex twice, is better handled by rebuild_levels"""
+    return len(region) > REBUILD_SHARE * vertex_num and len(set(region)) > REBUILD_SHARE * vertex_num
+
+
+def rebuild_levels(graph: SparseGraph, order: List[List[float]], k: int, stats: UCO.PruningStats = None) -> Set[int]:
+    """
+    peel the levels from k up again with UCO.peel_levels, for the regions too large for
+    repeel_region. the DP tables are extended from one level to the next as in UCO_Index, so it
+    costs at most as much as building the index again
+    :param order: the levels below k are up to date, the others are replaced in place
+    :return: the k whose thresholds changed
+    """
+    survivors = [v for v, row in enumerate(order) if len(row) >= k - 1] if k > 1 else None
+    old = [row[k - 1:] for row in order]
+    for row in order:
+        del row[k - 1:]
+    for _, level in UCO.peel_levels(graph, k, survivors, stats):
+        for v, thres in level:
+            order[v].append(thres)
+
+    levels = set()
+    for row, tail in zip(order, old):
+        new_tail = row[k - 1:]
+        if new_tail != tail:
+            levels.update(k + i for i in range(max(len(tail), len(new_tail)))
+                          if i >= min(len(tail), len(new_tail)) or tail[i] != new_tail[i])
+    return levels
+
+
+def write_level(order: List[List[float]], k: int, thresholds: Dict[int, float],
+                previous: Dict[int, List[float]]) -> bool:
+    """
+    write the k-thresholds back to order, those which do not pass CUT_OFF cut the row.
+    the rows are kept in previous before they are cut for the first time
+    :return: whether any threshold of k changed
+    """
+    changed = False
+    for v, thres in thresholds.items():
+        row = order[v]
+        if thres > UCO.CUT_OFF:
+            if len(row) >= k:
+                changed = changed or row[k - 1] != thres
+                row[k - 1] = thres
+            else:
+                changed = True
+                row.append(thres)
+        elif len(row) >= k:
+            changed = True
+            previous.setdefault(v, list(row))
+            del row[k - 1:]
 
+    return changed
 
-def upper_bound_updating(ub1: float, ub2: float) -> float:
+
+def maintain_levels(graph: SparseGraph, order: List[List[float]], increased: List[Tuple[int, int]],
+                    decreased: List[Tuple[int, int]], stats: UCO.PruningStats = None,
+                    first_level: int = 1) -> Set[int]:
     """
-    omit the tiny change in upper_bound
-    :param ub1: old upper_bound
-    :param ub2: new upper_bound
-    :return: new upper_bound
+    bring order up to date after the probs of the edges have changed in graph, level by level.
+    for every k the regions of the decreases and of the increases are merged, and the merged region
+    is peeled once, or the levels from k up are peeled again when it is too large, see REBUILD_SHARE. the levels grow as long as a vertex of the top level may pass CUT_OFF for the
+    next k, so a new level k_max + 1 is only searched around the increased edges
+    :param graph: the graph after the updates
+    :param order: the order of UCO_Index before the updates, updated in place
+    :param increased: the endpoints of the edges whose probs increased
+    :param decreased: the endpoints of the edges whose probs decreased
+    :param stats: count the DP evaluations
+    :param first_level: the levels below it are up to date already, and the rows of order were not
+        cut on them since the updates, see old_threshold
+    :return: the k whose thresholds changed
     """
-    if ub2 - ub1 > .0001:
-        return ub2
-    return ub1
+    previous, levels = {}, set()
+    workspace = RegionWorkspace(len(graph))
+    k_max = max(map(len, order), default=0)
+    k = first_level
+    while k <= k_max + (1 if increased else 0):
+        region, lowered = decrease_region(graph, order, previous, k, decreased, workspace)
+        region += increase_region(graph, order, previous, k, increased, workspace, lowered)
+        if region:
+            if too_large(region, len(graph)):
+                return levels | rebuild_levels(graph, order, k, stats)
+            new_thresholds = repeel_region(graph, order, k, region, workspace, stats)
+            if write_level(order, k, new_thresholds, previous):
+                levels.add(k)
+            if any(thres > UCO.CUT_OFF for thres in new_thresholds.values()):
+                k_max = max(k_max, k)
+        k += 1
+
+    return levels
 
 
-def delete_edges(graph: List[List[float]], updating_vertex: List[int]):
-    updating_vertex = set(updating_vertex)
-    for i in range(len(graph)):
-        for j in range(len(graph)):
-            if i not in updating_vertex or j not in updating_vertex:
-                graph[i][j] = .0
+@wrapper
+def batch_core_maintenance(graph: SparseGraph, order: List[List[float]], updates: List[Tuple[int, int, float]],
+                           filename: str = 'unknown', stats: UCO.PruningStats = None,
+                           levels: Set[int] = None) -> List[List[float]]:
+    """
+    apply a batch of edge updates to graph and bring the order of UCO_Index up to date,
+    see maintain_levels
+    :param graph: the updates are applied to it, a prob of 0 deletes the edge
+    :param order: the order of UCO_Index before the updates, updated in place
+    :param updates: (u, v, new_p)
+    :param filename: used by the log
+    :param stats: count the pruned vertexes and the DP evaluations
+    :param levels: the k whose thresholds changed are added to it, including the new levels
+    :return: order
+    """
+    stats = stats if stats is not None else UCO.PruningStats()
+    changed = [(u, v, p, graph.get_prob(u, v)) for u, v, p in updates if graph.get_prob(u, v) != p]
+    graph.set_probs(updates)
+    increased = [(u, v) for u, v, p, old in changed if p > old]
+    decreased = [(u, v) for u, v, p, old in changed if p < old]
 
-    return graph
+    changed_levels = maintain_levels(graph, order, increased, decreased, stats)
+    if levels is not None:
+        levels |= changed_levels
+
+    logging.info('batch_core_maintenance of %s: %d updates, %s', filename, len(changed), stats)
+    return order
 
 
 def transpose_matrix(k_probs: List[List[float]]):
@@ -188,15 +359,14 @@ def transpose_matrix(k_probs: List[List[float]]):
         exit(-1)
 
 
-def change_graph(graph: List[List[float]]):
+def change_graph(graph: SparseGraph):
     i, j = 2, 3
     assert i != j, "i can not equal to j"
 
     new_value = .8
     assert new_value <= 1, "the weight of edge can't larger then 1"
 
-    graph[i][j] = new_value
-    graph[j][i] = new_value
+    graph.set_prob(i, j, new_value)
     return graph
 
 
@@ -213,11 +383,24 @@ def reorg_heap(heap: List[List[float]], k_core: int):
 
 @wrapper
 def core_maintenance(k_core, origin_heap, changed_points, graph, filename = 'unknown'):
-    final_index = []
-    for i in range(1, k_core + 1):
-        final_index.append(cal_k_probs_when_inserting(graph, origin_heap, i, changed_points))
+    """
+    maintain the levels of reorg_heap after the prob of the edge changed_points increased in graph
+    :param k_core: the number of levels of origin_heap
+    :param origin_heap: reorg_heap of the order of UCO_Index, updated in place. a level is appended
+        when the increase lets a vertex pass CUT_OFF for k_core + 1
+    :param changed_points: the endpoints of the edge
+    :param graph: the graph after the increase
+    :param filename: used by the log
+    :return: origin_heap
+    """
+    stats = UCO.PruningStats()
+    order = transpose_matrix(origin_heap) if origin_heap else [[] for _ in range(len(graph))]
+    order = [row[:next((i for i, t in enumerate(row) if t <= UCO.CUT_OFF), len(row))] for row in order]
+    maintain_levels(graph, order, [tuple(changed_points)], [], stats)
+    origin_heap[:] = reorg_heap(order, max(k_core, max((len(row) for row in order), default=0)))
 
-    return final_index
+    logging.info('core_maintenance of %s: %s', filename, stats)
+    return origin_heap
 
 
 def cal_files(filename):
@@ -230,12 +413,12 @@ def cal_files(filename):
 
     temp_heap = reorg_heap(heaps, k_core)
 
-    for h in heaps:
-        k_core = max(k_core, len(h))
     for i in range(10):
         indexes_of_changed_points = pipeline_change_map(graph, True)
         # UCO.UCO_Index(graph, filename=filename)
         core_maintenance(k_core, temp_heap, indexes_of_changed_points, copy.deepcopy(graph), filename=filename)
+        # the increase may have added a level
+        k_core = len(temp_heap)
 
 
 def main():
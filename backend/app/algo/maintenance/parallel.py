@@ -0,0 +1,277 @@
+"""
+the levels of a maintenance batch in worker processes. a level k only reads the k-thresholds of
+the other vertexes and, for the increases, bounds its region by the new thresholds of k - 1. the
+k-probs bound it as well, so every level is searched and re-peeled on its own against the graph
+after the updates and the order before them, which are put into shared memory and mapped by
+every worker instead of being pickled per task. the workers and the blocks are kept from one
+batch to the next by a MaintenancePool, so a batch only copies the arrays which changed.
+"""
+import atexit
+import logging
+import os
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+from app.algo.UCO import uco as UCO
+from app.algo.decorate import wrapper
+from app.algo.maintenance.maintenance import (RegionWorkspace, decrease_region, increase_region,
+                                              maintain_levels, rebuild_levels, reorg_heap, repeel_region,
+                                              too_large, transpose_matrix, write_level)
+from app.algo.sparse_graph import SparseGraph
+
+# the blocks, the graph, the order and the workspace of a worker, see _attach
+_shared = {}
+# the pools of parallel_maintain_levels by number of workers, see get_pool
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class SharedOrder:
+    """the rows of the order of UCO_Index over CSR arrays, order[v] is a read-only view"""
+    __slots__ = ('offsets', 'thresholds')
+
+    def __init__(self, offsets, thresholds):
+        self.offsets = offsets
+        self.thresholds = thresholds
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, v: int):
+        return self.thresholds[self.offsets[v]:self.offsets[v + 1]]
+
+
+def attach_arrays(specs) -> Tuple[List[shared_memory.SharedMemory], Dict[str, memoryview]]:
+    """
+    map the blocks of MaintenancePool.publish. the arrays are memoryviews, which index to python
+    numbers like the arrays of SparseGraph, so nothing is copied
+    """
+    blocks, arrays = [], {}
+    for name, (block_name, char, nbytes) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = block.buf[:nbytes].cast(char)
+    return blocks, arrays
+
+
+class MaintenancePool:
+    """
+    the worker processes of parallel_maintain_levels and the shared memory blocks they map, kept
+    from one batch to the next. publish copies an array into its block only if it changed since
+    the last batch, in place when its size did not change, and the workers map the blocks again
+    only when a block was replaced, so they keep their workspace as well
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def publish(self, arrays: Dict[str, np.ndarray]) -> Dict[str, Tuple[str, str, int]]:
+        """
+        bring the blocks up to date with arrays
+        :return: the specs passed to the workers, see attach_arrays
+        """
+        specs = {}
+        for name, values in arrays.items():
+            values = np.ascontiguousarray(values)
+            spec, block = self.blocks.get(name, (None, None))
+            if spec is None or spec[1:] != (values.dtype.char, values.nbytes):
+                if block is not None:
+                    block.close()
+                    block.unlink()
+                block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+                spec = (block.name, values.dtype.char, values.nbytes)
+                self.blocks[name] = spec, block
+                np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+            else:
+                view = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+                if not np.array_equal(view, values):
+                    view[...] = values
+            specs[name] = spec
+        return specs
+
+    def map(self, fn, *iterables) -> list:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        return list(self.executor.map(fn, *iterables))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        for _, block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self) -> 'MaintenancePool':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_pool(workers: int = None) -> MaintenancePool:
+    """the pool of workers processes kept for the process, closed at exit"""
+    workers = workers or os.cpu_count() or 1
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = MaintenancePool(workers)
+        return _pools[workers]
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def _attach(specs):
+    """map the blocks of specs which the worker did not map yet, the others are kept"""
+    blocks = _shared.setdefault('blocks', {})
+    changed = [name for name, spec in specs.items() if blocks.get(name, (None,))[0] != spec]
+    if not changed:
+        return
+    # the views of a replaced block are dropped before it is closed
+    arrays = _shared.setdefault('arrays', {})
+    _shared.pop('graph', None)
+    _shared.pop('order', None)
+    for name in changed:
+        arrays.pop(name, None)
+        if name in blocks:
+            try:
+                blocks.pop(name)[1].close()
+            except BufferError:
+                pass
+        new_blocks, new_arrays = attach_arrays({name: specs[name]})
+        blocks[name] = specs[name], new_blocks[0]
+        arrays[name] = new_arrays[name]
+
+    graph = SparseGraph(arrays['offsets'], arrays['neighbors'], arrays['probs'])
+    _shared['graph'] = graph
+    _shared['order'] = SharedOrder(arrays['order_offsets'], arrays['order_thresholds'])
+    workspace = _shared.get('workspace')
+    if workspace is None or len(workspace.epoch) != len(graph):
+        _shared['workspace'] = RegionWorkspace(len(graph))
+
+
+def maintain_level(specs, k: int, increased: List[Tuple[int, int]], decreased: List[Tuple[int, int]]):
+    """
+    run in the workers: the new k-thresholds of the region of the updates, see maintain_levels
+    :param specs: the blocks of the graph and of the order, see MaintenancePool.publish
+    :return: (k, vertexes, thresholds, PruningStats), vertexes and thresholds are None when the
+        region is too large, the levels from k up are rebuilt by the caller then
+    """
+    _attach(specs)
+    graph, order, workspace = _shared['graph'], _shared['order'], _shared['workspace']
+    stats = UCO.PruningStats()
+    region, lowered = decrease_region(graph, order, {}, k, decreased, workspace)
+    region += increase_region(graph, order, {}, k, increased, workspace, lowered, lower_level=False)
+
+    vertexes, thresholds = array('i'), array('d')
+    if too_large(region, len(graph)):
+        return k, None, None, stats
+    if region:
+        for v, thres in repeel_region(graph, order, k, region, workspace, stats).items():
+            vertexes.append(v)
+            thresholds.append(thres)
+    return k, vertexes, thresholds, stats
+
+
+def parallel_maintain_levels(graph: SparseGraph, order: List[List[float]], increased: List[Tuple[int, int]],
+                             decreased: List[Tuple[int, int]], workers: int = None,
+                             stats: UCO.PruningStats = None, pool: MaintenancePool = None) -> Set[int]:
+    """
+    maintain_levels with the levels up to k_max + 1 in worker processes. a level above it can
+    only appear after k_max + 1 did, it is added by maintain_levels afterwards
+    :param graph: the graph after the updates
+    :param order: the order of UCO_Index before the updates, updated in place
+    :param increased: the endpoints of the edges whose probs increased
+    :param decreased: the endpoints of the edges whose probs decreased
+    :param workers: the number of processes, os.cpu_count() by default
+    :param stats: sum of the PruningStats of the workers
+    :param pool: the pool to run the levels in, the one of get_pool(workers) by default
+    :return: the k whose thresholds changed
+    """
+    k_max = max(map(len, order), default=0)
+    ks = list(range(1, k_max + (2 if increased else 1)))
+    if not ks:
+        return set()
+
+    lengths = np.fromiter(map(len, order), dtype=np.int64, count=len(order))
+    order_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=order_offsets[1:])
+    pool = pool or get_pool(workers)
+    with pool.lock:
+        specs = pool.publish({
+            'offsets': np.asarray(graph.offsets),
+            'neighbors': np.asarray(graph.neighbors),
+            'probs': np.asarray(graph.probs),
+            'order_offsets': order_offsets,
+            'order_thresholds': np.fromiter((t for row in order for t in row), dtype=np.float64,
+                                            count=order_offsets[-1]),
+        })
+        outputs = pool.map(maintain_level, [specs] * len(ks), ks, [increased] * len(ks), [decreased] * len(ks))
+
+    # the levels are written from the bottom up, so a row cut on k is never extended above it
+    rebuild = min((k for k, vertexes, _, _ in outputs if vertexes is None), default=None)
+    levels, previous = set(), {}
+    for k, vertexes, thresholds, level_stats in outputs:
+        if stats is not None:
+            stats.merge(level_stats)
+        if rebuild is None or k < rebuild:
+            if write_level(order, k, dict(zip(vertexes, thresholds)), previous):
+                levels.add(k)
+
+    if rebuild is not None:
+        return levels | rebuild_levels(graph, order, rebuild, stats)
+    return levels | maintain_levels(graph, order, increased, [], stats, first_level=k_max + 2)
+
+
+@wrapper
+def parallel_batch_core_maintenance(graph: SparseGraph, order: List[List[float]],
+                                    updates: List[Tuple[int, int, float]], filename: str = 'unknown',
+                                    workers: int = None, stats: UCO.PruningStats = None,
+                                    levels: Set[int] = None) -> List[List[float]]:
+    """
+    batch_core_maintenance with the levels maintained in worker processes, see
+    parallel_maintain_levels
+    :return: order
+    """
+    stats = stats if stats is not None else UCO.PruningStats()
+    changed = [(u, v, p, graph.get_prob(u, v)) for u, v, p in updates if graph.get_prob(u, v) != p]
+    graph.set_probs(updates)
+    increased = [(u, v) for u, v, p, old in changed if p > old]
+    decreased = [(u, v) for u, v, p, old in changed if p < old]
+
+    changed_levels = parallel_maintain_levels(graph, order, increased, decreased, workers, stats)
+    if levels is not None:
+        levels |= changed_levels
+
+    logging.info('parallel_batch_core_maintenance of %s: %d updates, %s', filename, len(changed), stats)
+    return order
+
+
+@wrapper
+def parallel_core_maintenance(k_core, origin_heap, changed_points, graph, filename='unknown', workers=None):
+    """
+    core_maintenance with the levels maintained in worker processes, see parallel_maintain_levels
+    :return: origin_heap
+    """
+    stats = UCO.PruningStats()
+    order = transpose_matrix(origin_heap) if origin_heap else [[] for _ in range(len(graph))]
+    order = [row[:next((i for i, t in enumerate(row) if t <= UCO.CUT_OFF), len(row))] for row in order]
+    parallel_maintain_levels(graph, order, [tuple(changed_points)], [], workers, stats)
+    origin_heap[:] = reorg_heap(order, max(k_core, max(map(len, order), default=0)))
+
+    logging.info('parallel_core_maintenance of %s: %s', filename, stats)
+    return origin_heap
@@ -0,0 +1,179 @@
+"""
+answer (k, eta)-core queries from the forest of construct_tree and the ThresholdIndex taken from
+it, which are built once per graph and saved next to the graph file. the cores are read from the
+levels of the index and the communities from the trees of the forest. both are sets of read-only
+views of the mapped files, the recently used ones stay in memory, so a query on a warm graph is a
+binary search and a slice.
+"""
+import os
+import threading
+from functools import lru_cache
+from typing import List, Set, Tuple
+
+import numpy as np
+
+from app.algo.UCO import uco as UCO
+from app.algo.maintenance.maintenance import batch_core_maintenance
+from app.algo.tree.forest import Forest
+from app.algo.tree.tree_construct import construct_tree, update_forest
+from app.utils.graph_parser import read_graph_file, write_graph_file
+from app.utils.index_file import ThresholdIndex, index_path
+
+SUFFIX = '.forest'
+# the forests kept in memory
+CACHE_SIZE = 16
+
+# one lock per file being built, see _build_lock
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+
+def forest_path(graph_path: str) -> str:
+    """the forest file of the graph file graph_path"""
+    return os.path.splitext(graph_path)[0] + SUFFIX
+
+
+def _build_lock(path: str) -> threading.Lock:
+    """
+    the lock of a file built on demand, so that the first queries of a graph wait for one build
+    instead of each of them building the same file
+    """
+    with _build_locks_lock:
+        return _build_locks.setdefault(path, threading.Lock())
+
+
+def build_forest(graph_path: str) -> Forest:
+    """
+    construct the forest of the graph file and save it next to it. the trees are built with
+    UCO.CUT_OFF as threshold, so the cores are exact for eta above it
+    """
+    forest = construct_tree(read_graph_file(graph_path, writable=False), threshold=UCO.CUT_OFF)
+    forest.save(forest_path(graph_path))
+    return forest
+
+
+def build_index(graph_path: str):
+    """
+    build the forest and the index file of the graph file and save them next to it, which is done
+    once in a background process after the upload so that the queries only look them up. nothing
+    is returned, so nothing is sent back from the process. the index is taken from the thresholds
+    of the forest, they are the order of UCO_Index already
+    """
+    forest = build_forest(graph_path)
+    ThresholdIndex.from_order(forest.to_order(UCO.CUT_OFF)).save(index_path(graph_path))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _load_forest(path: str, mtime: float) -> Forest:
+    return Forest.load(path)
+
+
+def load_forest(graph_path: str) -> Forest:
+    """the forest of the graph file, built first if it is not there yet"""
+    path = forest_path(graph_path)
+    if not os.path.exists(path):
+        with _build_lock(path):
+            if not os.path.exists(path):
+                build_forest(graph_path)
+    # a rebuilt forest has a new mtime, so it is not mixed up with the cached one
+    return _load_forest(path, os.path.getmtime(path))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _load_index(path: str, mtime: float) -> ThresholdIndex:
+    return ThresholdIndex.load(path)
+
+
+def load_index(graph_path: str) -> ThresholdIndex:
+    """
+    the index file of the graph file, mapped read-only. it is taken from the forest first if it is
+    not there yet, e.g. for the graphs uploaded before the index was built at upload
+    """
+    path = index_path(graph_path)
+    if not os.path.exists(path):
+        forest = load_forest(graph_path)
+        with _build_lock(path):
+            if not os.path.exists(path):
+                ThresholdIndex.from_order(forest.to_order(UCO.CUT_OFF)).save(path)
+    return _load_index(path, os.path.getmtime(path))
+
+
+def update_edges(graph_path: str, updates: List[Tuple[int, int, float]]) -> Set[int]:
+    """
+    apply (u, v, new_p) to the graph file and maintain its forest and its index file instead of
+    building them again: only the trees of the levels which changed are rebuilt,
+    and a level which appears above the old k_max is added. an edge whose ends are both in the
+    tree of k may split or merge its components without moving a threshold, so that tree is
+    rebuilt as well
+    :return: the k whose thresholds changed
+    """
+    graph = read_graph_file(graph_path)
+    forest = load_forest(graph_path)
+    order = forest.to_order(UCO.CUT_OFF)
+    depths = [min(len(order[u]), len(order[v])) for u, v, _ in updates]
+
+    levels = set()
+    batch_core_maintenance(graph, order, updates, filename=graph_path, levels=levels)
+    write_graph_file(graph_path, graph)
+    # the levels holding both ends of an updated edge before or after the updates
+    depths += [min(len(order[u]), len(order[v])) for u, v, _ in updates]
+    trees = levels | set(range(1, max(depths, default=0) + 1))
+    if trees:
+        update_forest(forest, graph, order, trees).save(forest_path(graph_path))
+    if levels:
+        path = index_path(graph_path)
+        index = ThresholdIndex.load(path).replace_levels(order, levels) if os.path.exists(path) \
+            else ThresholdIndex.from_order(order)
+        index.save(path)
+    return levels
+
+
+def index_version(graph_path: str):
+    """
+    the mtime of the index file of the graph file in ns, None if it is not built yet. update_edges
+    and every build write a new file, so it tells whether what was taken from the index is stale
+    """
+    try:
+        return os.stat(index_path(graph_path)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def k_level(graph_path: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    the vertexes of level k of the graph file and their float32 thresholds, ascending by threshold,
+    which are views of the mapped index file. every (k, eta)-core is a tail of it, so it answers
+    the queries of any eta, see level_core
+    """
+    return load_index(graph_path).level(k)
+
+
+def level_core(vertexes: np.ndarray, thresholds: np.ndarray, eta: float) -> List[int]:
+    """
+    the (k, eta)-core of a level of k_level by a binary search, descending by threshold. eta is
+    compared in the precision of thresholds like ThresholdIndex.core does
+    """
+    return vertexes[np.searchsorted(thresholds, thresholds.dtype.type(eta)):][::-1].tolist()
+
+
+def k_eta_core(graph_path: str, k: int, eta: float) -> List[int]:
+    """
+    the (k, eta)-core of the graph file
+    :param graph_path: the graph file, see read_graph_file
+    :param k: k number
+    :param eta: the smallest probability for a vertex to have k neighbors in the core
+    :return: the vertexes of the core, descending by their threshold
+    """
+    return level_core(*k_level(graph_path, k), eta)
+
+
+def k_eta_community(graph_path: str, q: int, k: int, eta: float) -> List[int]:
+    """
+    the connected component of the (k, eta)-core which contains q, empty if q is not in the core
+    """
+    return load_forest(graph_path).community(q, k, eta).tolist()
+
+
+def k_eta_communities(graph_path: str, qs: List[int], k: int, eta: float) -> List[List[int]]:
+    """k_eta_community of many query vertexes"""
+    return [c.tolist() for c in load_forest(graph_path).communities(qs, k, eta)]
@@ -0,0 +1,288 @@
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+
+class SparseGraph:
+    """
+    undirected uncertain graph stored in CSR layout.
+
+    the neighbours of v are neighbors[offsets[v]:offsets[v + 1]] (sorted ascending) and the
+    probability of each edge is stored at the same position in probs, so memory is O(n + m)
+    and walking the neighbours of v is O(deg(v)).
+    removed is the deletion mask used while peeling: a removed vertex is skipped as a neighbour
+    of every other vertex. an edge whose probability is set to 0 is treated as deleted too.
+    """
+    offsets: array
+    neighbors: array
+    probs: array
+    removed: bytearray
+
+    def __init__(self, offsets, neighbors, probs, removed: bytearray = None):
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.probs = probs
+        self.vertex_num = len(offsets) - 1
+        self.removed = removed if removed is not None else bytearray(self.vertex_num)
+
+    @classmethod
+    def from_edges(cls, edges: Iterable[Tuple[int, int, float]], vertex_num: int) -> 'SparseGraph':
+        """
+        build the CSR arrays from an edge list
+        :param edges: (v1, v2, prob), a repeated edge overrides the previous one like the dense matrix did
+        :param vertex_num: the number of vertices
+        :return: SparseGraph
+        """
+        weights = {}
+        for v1, v2, prob in edges:
+            if v1 == v2:
+                continue
+            if v1 > v2:
+                v1, v2 = v2, v1
+            weights[(v1, v2)] = prob
+
+        degree = [0 for _ in range(vertex_num)]
+        for (v1, v2), prob in weights.items():
+            if prob != 0:
+                degree[v1] += 1
+                degree[v2] += 1
+
+        offsets = array('q', [0]) * (vertex_num + 1)
+        for v in range(vertex_num):
+            offsets[v + 1] = offsets[v] + degree[v]
+
+        neighbors = array('i', [0]) * offsets[vertex_num]
+        probs = array('d', [.0]) * offsets[vertex_num]
+        cursor = list(offsets[:vertex_num])
+        # sorted by (v1, v2) so that every neighbour list ends up ascending
+        for (v1, v2), prob in sorted(weights.items()):
+            if prob == 0:
+                continue
+            neighbors[cursor[v1]], probs[cursor[v1]] = v2, prob
+            neighbors[cursor[v2]], probs[cursor[v2]] = v1, prob
+            cursor[v1] += 1
+            cursor[v2] += 1
+
+        return cls(offsets, neighbors, probs)
+
+    @classmethod
+    def from_arrays(cls, v1: np.ndarray, v2: np.ndarray, probs: np.ndarray, vertex_num: int) -> 'SparseGraph':
+        """
+        same as from_edges for an edge list given as three parallel arrays, the CSR arrays are built
+        by sorting instead of a dict, so 10 ** 7 edges take seconds
+        :param v1: the first ends
+        :param v2: the second ends
+        :param probs: the probabilities, a repeated edge overrides the previous one
+        :param vertex_num: the number of vertices
+        :return: SparseGraph
+        """
+        v1, v2 = np.asarray(v1, dtype=np.int64), np.asarray(v2, dtype=np.int64)
+        probs = np.asarray(probs, dtype=np.float64)
+        low, high = np.minimum(v1, v2), np.maximum(v1, v2)
+
+        # the last occurrence of every edge is the first one of the reversed keys
+        base = max(vertex_num, 1)
+        keys = (low * base + high)[::-1]
+        keys, first = np.unique(keys, return_index=True)
+        probs = probs[::-1][first]
+        low, high = keys // base, keys % base
+        keep = (low != high) & (probs != 0)
+        low, high, probs = low[keep], high[keep], probs[keep]
+
+        rows, cols = np.concatenate((low, high)), np.concatenate((high, low))
+        order = np.lexsort((cols, rows))
+        offsets = np.zeros(vertex_num + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=vertex_num), out=offsets[1:])
+
+        return cls(array('q', offsets.tobytes()), array('i', cols[order].astype(np.int32).tobytes()),
+                   array('d', np.concatenate((probs, probs))[order].tobytes()))
+
+    @classmethod
+    def from_matrix(cls, matrix: List[List[float]]) -> 'SparseGraph':
+        n = len(matrix)
+        edges = ((i, j, matrix[i][j]) for i in range(n) for j in range(i + 1, n) if matrix[i][j] != 0)
+        return cls.from_edges(edges, n)
+
+    def __len__(self) -> int:
+        return self.vertex_num
+
+    def __repr__(self) -> str:
+        return f'SparseGraph(n={self.vertex_num}, m={self.edge_num()})'
+
+    def edge_num(self) -> int:
+        return len(self.neighbors) // 2
+
+    def neighbors_of(self, v: int) -> List[int]:
+        """the neighbours of v which are not removed, ascending"""
+        removed = self.removed
+        start, end = self.offsets[v], self.offsets[v + 1]
+        return [u for u, p in zip(self.neighbors[start:end], self.probs[start:end])
+                if not removed[u] and p != 0]
+
+    def neighbor_probs(self, v: int) -> List[float]:
+        """the probabilities of the edges between v and its live neighbours, ascending by neighbour"""
+        removed = self.removed
+        start, end = self.offsets[v], self.offsets[v + 1]
+        return [p for u, p in zip(self.neighbors[start:end], self.probs[start:end])
+                if not removed[u] and p != 0]
+
+    def neighbor_items(self, v: int) -> List[Tuple[int, float]]:
+        """(neighbour, prob) of the live neighbours of v, ascending"""
+        removed = self.removed
+        start, end = self.offsets[v], self.offsets[v + 1]
+        return [(u, p) for u, p in zip(self.neighbors[start:end], self.probs[start:end])
+                if not removed[u] and p != 0]
+
+    def degree(self, v: int) -> int:
+        return len(self.neighbors_of(v))
+
+    def has_edges(self, v: int) -> bool:
+        """whether v still owns a non-zero edge, the neighbour's mask is not taken into account"""
+        start, end = self.offsets[v], self.offsets[v + 1]
+        return any(p != 0 for p in self.probs[start:end])
+
+    def edges(self) -> Iterator[Tuple[int, int, float]]:
+        """iterate the live edges (v1, v2, prob) with v1 < v2"""
+        removed = self.removed
+        for v1 in range(self.vertex_num):
+            if removed[v1]:
+                continue
+            start, end = self.offsets[v1], self.offsets[v1 + 1]
+            for v2, prob in zip(self.neighbors[start:end], self.probs[start:end]):
+                if v2 > v1 and not removed[v2] and prob != 0:
+                    yield v1, v2, prob
+
+    def edge_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """the live edges of edges() as three arrays (v1, v2, prob), ascending by (v1, v2)"""
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        v1 = np.repeat(np.arange(self.vertex_num, dtype=np.int32), np.diff(offsets))
+        v2, probs = np.asarray(self.neighbors, dtype=np.int32), np.asarray(self.probs, dtype=np.float64)
+        removed = np.frombuffer(self.removed, dtype=np.uint8) != 0
+        keep = (v1 < v2) & (probs != 0) & ~removed[v1] & ~removed[v2]
+        return v1[keep], v2[keep], probs[keep]
+
+    def _position(self, v1: int, v2: int) -> int:
+        start, end = self.offsets[v1], self.offsets[v1 + 1]
+        i = bisect_left(self.neighbors, v2, start, end)
+        if i < end and self.neighbors[i] == v2:
+            return i
+        return -1
+
+    def get_prob(self, v1: int, v2: int) -> float:
+        i = self._position(v1, v2)
+        return self.probs[i] if i != -1 else .0
+
+    def set_prob(self, v1: int, v2: int, prob: float):
+        """
+        change the probability of edge (v1, v2) in place, setting it to 0 deletes the edge.
+        an edge that is not stored yet makes the CSR arrays to be rebuilt, which costs O(n + m)
+        """
+        assert v1 != v2, "self loop is not supported"
+        i, j = self._position(v1, v2), self._position(v2, v1)
+        if i != -1:
+            self.probs[i] = prob
+            self.probs[j] = prob
+        elif prob != 0:
+            self._insert([(v1, v2, prob)])
+
+    def set_probs(self, updates: Iterable[Tuple[int, int, float]]):
+        """
+        set_prob for many edges, the edges which are not stored yet are added by one rebuild
+        """
+        missing = []
+        for v1, v2, prob in updates:
+            assert v1 != v2, "self loop is not supported"
+            i, j = self._position(v1, v2), self._position(v2, v1)
+            if i != -1:
+                self.probs[i] = prob
+                self.probs[j] = prob
+            else:
+                # a 0 is kept as well, it deletes an edge added earlier in the same batch
+                missing.append((v1, v2, prob))
+        if any(prob != 0 for _, _, prob in missing):
+            self._insert(missing)
+
+    def _insert(self, edges: List[Tuple[int, int, float]]):
+        """rebuild the CSR arrays with the edges which are not stored yet by from_arrays"""
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        v1 = np.repeat(np.arange(self.vertex_num, dtype=np.int64), np.diff(offsets))
+        v2, probs = np.asarray(self.neighbors, dtype=np.int64), np.asarray(self.probs, dtype=np.float64)
+        # every stored edge once, with its probability even if it is 0, like stored_edges
+        upper = v1 < v2
+        new_v1, new_v2, new_probs = (np.array(column) for column in zip(*edges))
+        graph = SparseGraph.from_arrays(np.concatenate((v1[upper], new_v1)), np.concatenate((v2[upper], new_v2)),
+                                        np.concatenate((probs[upper], new_probs)), self.vertex_num)
+        self.offsets, self.neighbors, self.probs = graph.offsets, graph.neighbors, graph.probs
+
+    def stored_edges(self) -> Iterator[Tuple[int, int, float]]:
+        """iterate every stored edge, the mask and the probability are ignored"""
+        for v1 in range(self.vertex_num):
+            start, end = self.offsets[v1], self.offsets[v1 + 1]
+            for v2, prob in zip(self.neighbors[start:end], self.probs[start:end]):
+                if v2 > v1:
+                    yield v1, v2, prob
+
+    def remove_vertex(self, v: int):
+        self.removed[v] = 1
+
+    def is_removed(self, v: int) -> bool:
+        return self.removed[v] == 1
+
+    def copy(self) -> 'SparseGraph':
+        """
+        copy the deletion mask only, the CSR arrays are shared with self.
+        use copy.deepcopy to get a graph whose probabilities can be changed independently
+        """
+        return SparseGraph(self.offsets, self.neighbors, self.probs, bytearray(self.removed))
+
+    def restrict(self, vertexes: Iterable[int]) -> 'SparseGraph':
+        """a copy where every vertex out of vertexes is removed"""
+        removed = bytearray(b'\x01') * self.vertex_num
+        for v in vertexes:
+            removed[v] = self.removed[v]
+        return SparseGraph(self.offsets, self.neighbors, self.probs, removed)
+
+    def induced_subgraph(self, vertexes: Iterable[int], relabel: np.ndarray = None) -> 'SparseGraph':
+        """
+        the subgraph induced by the live vertexes of vertexes as a compact graph of its own, vertex
+        sorted(vertexes)[i] becomes i. it shares nothing with self, so it is cheap to pickle
+        :param vertexes: the vertexes to keep
+        :param relabel: a -1 filled int64 array of vertex_num used instead of allocating one, it is
+            -1 filled again on return, so a small subgraph costs its own size only
+        """
+        vertexes = np.unique(np.asarray(list(vertexes), dtype=np.int64))
+        alive = np.frombuffer(self.removed, dtype=np.uint8)[vertexes] == 0
+        local = relabel if relabel is not None else np.full(self.vertex_num, -1, dtype=np.int64)
+        local[vertexes[alive]] = np.nonzero(alive)[0]
+
+        offsets = np.asarray(self.offsets)
+        starts = offsets[vertexes]
+        lengths = offsets[vertexes + 1] - starts
+        rows = np.repeat(np.arange(len(vertexes)), lengths)
+        position = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+        neighbors = local[np.asarray(self.neighbors)[position]]
+        local[vertexes] = -1
+        probs = np.asarray(self.probs)[position]
+        keep = (neighbors >= 0) & (probs != 0) & alive[rows]
+        new_offsets = np.zeros(len(vertexes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=len(vertexes)), out=new_offsets[1:])
+
+        return SparseGraph(array('q', new_offsets.tobytes()), array('i', neighbors[keep].astype(np.int32).tobytes()),
+                           array('d', probs[keep].tobytes()))
+
+    def to_matrix(self) -> List[List[float]]:
+        matrix = [[.0 for _ in range(self.vertex_num)] for _ in range(self.vertex_num)]
+        for v1, v2, prob in self.edges():
+            matrix[v1][v2] = prob
+            matrix[v2][v1] = prob
+        return matrix
+
+
+def as_sparse_graph(graph) -> SparseGraph:
+    """accept both SparseGraph and the old 2-D matrix"""
+    if isinstance(graph, SparseGraph):
+        return graph
+    return SparseGraph.from_matrix(graph)
@@ -0,0 +1,304 @@
+from array import array
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from app.utils.binfile import load_arrays, save_arrays
+
+KIND = 'uco-forest'
+
+
+def _children(parent: np.ndarray):
+    """(child_offsets, children) of the parent array, grouped by parent, by node index inside a group"""
+    has_parent = np.nonzero(parent != -1)[0]
+    children = has_parent[np.argsort(parent[has_parent], kind='stable')]
+    child_offsets = np.zeros(len(parent) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parent[has_parent], minlength=len(parent)), out=child_offsets[1:])
+    return child_offsets, children
+
+
+def _segments(offsets: np.ndarray, values: np.ndarray, nodes: np.ndarray):
+    """(offsets, values) of the segments of nodes only, in the order of nodes"""
+    lengths = np.diff(offsets)[nodes]
+    new_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.repeat(offsets[nodes] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return new_offsets, values[positions]
+
+
+class Forest:
+    """
+    the eta-k trees of every k in flat arrays, a node is an index into them:
+    parent[x] (-1 for a root), threshold[x] and k[x] describe node x, its vertexes are
+    vertexes[vertex_offsets[x]:vertex_offsets[x + 1]] and its children are
+    children[child_offsets[x]:child_offsets[x + 1]].
+    roots[k] is the root returned by construct_eta_k_tree for k, -1 if the tree is empty.
+
+    leaf_nodes[leaf_offsets[v] + k - 1] is the node holding v in the tree of k, the row of v stops
+    at the highest k whose tree holds v and has -1 for a k below it whose tree does not, so the
+    memory is that of the (k, v) pairs with a node, the same rows as the index file, not k_max * n.
+
+    the vertexes of the subtree of x are layout[span_start[x]:span_end[x]], the layout is a
+    post-order walk of the trees, so a community is a slice of it. the (k, eta)-cores are answered
+    by the levels of the ThresholdIndex taken from to_order, the forest does not keep them twice.
+    """
+    ARRAYS = ('parent', 'threshold', 'k', 'vertex_offsets', 'vertexes', 'child_offsets', 'children',
+              'roots', 'layout', 'span_start', 'span_end', 'leaf_offsets', 'leaf_nodes')
+    __slots__ = ARRAYS + ('n',)
+
+    def __init__(self, parent, threshold, k, vertex_offsets, vertexes, child_offsets, children, roots,
+                 vertex_num: int, layout=None, span_start=None, span_end=None,
+                 leaf_offsets=None, leaf_nodes=None):
+        self.parent = parent
+        self.threshold = threshold
+        self.k = k
+        self.vertex_offsets = vertex_offsets
+        self.vertexes = vertexes
+        self.child_offsets = child_offsets
+        self.children = children
+        self.roots = roots
+        self.n = vertex_num
+        if layout is None:
+            layout, span_start, span_end = self._post_order()
+        if leaf_offsets is None:
+            leaf_offsets, leaf_nodes = self._leaves()
+        self.layout = layout
+        self.span_start = span_start
+        self.span_end = span_end
+        self.leaf_offsets = leaf_offsets
+        self.leaf_nodes = leaf_nodes
+
+    def _post_order(self):
+        layout = np.empty(len(self.vertexes), dtype=np.int32)
+        span_start = np.empty(len(self), dtype=np.int64)
+        span_end = np.empty(len(self), dtype=np.int64)
+        position = 0
+        for root in np.nonzero(self.parent == -1)[0].tolist():
+            stack = [(root, False)]
+            while stack:
+                x, done = stack.pop()
+                if done:
+                    start, end = self.vertex_offsets[x], self.vertex_offsets[x + 1]
+                    layout[position:position + end - start] = self.vertexes[start:end]
+                    position += end - start
+                    span_end[x] = position
+                    continue
+                span_start[x] = position
+                stack.append((x, True))
+                stack.extend((c, False) for c in self.node_children(x)[::-1].tolist())
+
+        return layout, span_start, span_end
+
+    def _leaves(self):
+        owner = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.vertex_offsets))
+        ks = self.k[owner].astype(np.int64)
+        depth = np.zeros(self.n, dtype=np.int64)
+        np.maximum.at(depth, self.vertexes, ks)
+        leaf_offsets = np.zeros(self.n + 1, dtype=np.int64)
+        np.cumsum(depth, out=leaf_offsets[1:])
+        leaf_nodes = np.full(leaf_offsets[-1], -1, dtype=np.int32)
+        leaf_nodes[leaf_offsets[self.vertexes] + ks - 1] = owner
+        return leaf_offsets, leaf_nodes
+
+    @classmethod
+    def load(cls, path: str) -> 'Forest':
+        """map the file written by save, the arrays are read-only views of it"""
+        arrays, meta = load_arrays(path, KIND)
+        return cls(vertex_num=meta['vertex_num'], **{name: arrays[name] for name in cls.ARRAYS})
+
+    def save(self, path: str):
+        save_arrays(path, {name: getattr(self, name) for name in self.ARRAYS},
+                    {'vertex_num': self.vertex_num(), 'k_max': self.k_max()}, KIND)
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    def k_max(self) -> int:
+        return len(self.roots) - 1
+
+    def vertex_num(self) -> int:
+        return self.n
+
+    def node_vertexes(self, x: int) -> np.ndarray:
+        return self.vertexes[self.vertex_offsets[x]:self.vertex_offsets[x + 1]]
+
+    def node_children(self, x: int) -> np.ndarray:
+        return self.children[self.child_offsets[x]:self.child_offsets[x + 1]]
+
+    def node_of(self, v: int, k: int) -> int:
+        """the node holding v in the tree of k, -1 if there is none"""
+        start, end = self.leaf_offsets[v], self.leaf_offsets[v + 1]
+        return int(self.leaf_nodes[start + k - 1]) if 0 < k <= end - start else -1
+
+    def subtree(self, x: int) -> np.ndarray:
+        """the vertexes of the subtree of x"""
+        return self.layout[self.span_start[x]:self.span_end[x]]
+
+    def community_node(self, q: int, k: int, eta: float) -> int:
+        """
+        the highest ancestor of the leaf of q whose threshold is at least eta, -1 if q is not in the
+        (k, eta)-core. the thresholds only go down on the way up
+        """
+        x = self.node_of(q, k)
+        if x == -1 or self.threshold[x] < eta:
+            return -1
+        while self.parent[x] != -1 and self.threshold[self.parent[x]] >= eta:
+            x = int(self.parent[x])
+        return x
+
+    def community(self, q: int, k: int, eta: float) -> np.ndarray:
+        """the connected component of the (k, eta)-core which contains q, empty if there is none"""
+        x = self.community_node(q, k, eta)
+        return self.subtree(x) if x != -1 else self.layout[:0]
+
+    def community_nodes(self, qs, k: int, eta: float) -> np.ndarray:
+        """community_node of many query vertexes at once, climbing all of them in lockstep"""
+        qs = np.asarray(qs, dtype=np.int64)
+        start = self.leaf_offsets[qs]
+        found = (0 < k) & (k <= self.leaf_offsets[qs + 1] - start)
+        x = np.full(len(qs), -1, dtype=np.int64)
+        x[found] = self.leaf_nodes[start[found] + k - 1]
+        found &= x != -1
+        found[found] = self.threshold[x[found]] >= eta
+        x[~found] = -1
+
+        climbing = np.nonzero(found)[0]
+        while len(climbing) != 0:
+            father = self.parent[x[climbing]]
+            up = father != -1
+            up[up] = self.threshold[father[up]] >= eta
+            climbing = climbing[up]
+            x[climbing] = father[up]
+        return x
+
+    def communities(self, qs, k: int, eta: float) -> List[np.ndarray]:
+        """community of many query vertexes, the queries landing in the same node share one view"""
+        return [self.subtree(x) if x != -1 else self.layout[:0]
+                for x in self.community_nodes(qs, k, eta).tolist()]
+
+    def to_order(self, cut_off: float) -> List[List[float]]:
+        """
+        the order of UCO_Index, the thresholds of a vertex for k = 1, 2, ... until one of them does
+        not pass cut_off, which is the threshold the forest was built with or above it
+        """
+        starts, nodes = self.leaf_offsets, self.leaf_nodes
+        thresholds = np.where(nodes != -1, self.threshold[nodes], .0)
+        # a row stops at the first k which is missing or does not pass cut_off
+        vertexes = np.repeat(np.arange(self.n), np.diff(starts))
+        rank = np.arange(len(nodes)) - starts[vertexes]
+        lengths = np.diff(starts)
+        stop = thresholds <= cut_off
+        np.minimum.at(lengths, vertexes[stop], rank[stop])
+        return [thresholds[start:start + length].tolist()
+                for start, length in zip(starts[:-1].tolist(), lengths.tolist())]
+
+    def replace_levels(self, levels: Iterable[int], forest: 'Forest') -> 'Forest':
+        """
+        the trees of forest for levels and the trees of self for the other ones, so that a few levels
+        are rebuilt without the others, see update_forest. the empty levels on the top are dropped
+        """
+        assert forest.vertex_num() == self.vertex_num(), "the forests are of different graphs"
+        levels = set(levels)
+        level_list = np.fromiter(levels, dtype=np.int64, count=len(levels))
+        mine = np.nonzero(~np.isin(self.k, level_list))[0]
+        theirs = np.nonzero(np.isin(forest.k, level_list))[0]
+        # the nodes of self first, then those of forest. remap[-1] stays -1 for the missing ones
+        remap_mine = np.full(len(self) + 1, -1, dtype=np.int64)
+        remap_mine[mine] = np.arange(len(mine))
+        remap_theirs = np.full(len(forest) + 1, -1, dtype=np.int64)
+        remap_theirs[theirs] = len(mine) + np.arange(len(theirs))
+
+        parent = np.concatenate((remap_mine[self.parent[mine]], remap_theirs[forest.parent[theirs]]))
+        offsets_mine, vertexes_mine = _segments(self.vertex_offsets, self.vertexes, mine)
+        offsets_theirs, vertexes_theirs = _segments(forest.vertex_offsets, forest.vertexes, theirs)
+        vertex_offsets = np.concatenate((offsets_mine, offsets_theirs[1:] + offsets_mine[-1]))
+
+        k_max = max(self.k_max(), forest.k_max())
+        roots = np.full(k_max + 1, -1, dtype=np.int64)
+        for k in range(1, k_max + 1):
+            source, remap = (forest, remap_theirs) if k in levels else (self, remap_mine)
+            if k <= source.k_max():
+                roots[k] = remap[source.roots[k]]
+        while k_max > 0 and roots[k_max] == -1:
+            k_max -= 1
+
+        child_offsets, children = _children(parent)
+        return Forest(parent, np.concatenate((self.threshold[mine], forest.threshold[theirs])),
+                      np.concatenate((self.k[mine], forest.k[theirs])), vertex_offsets,
+                      np.concatenate((vertexes_mine, vertexes_theirs)), child_offsets, children,
+                      roots[:k_max + 1], self.vertex_num())
+
+    def root_of(self, x: int) -> int:
+        while self.parent[x] != -1:
+            x = int(self.parent[x])
+        return x
+
+    def to_tree_nodes(self) -> Dict[int, 'TreeNode']:
+        """
+        the TreeNode objects construct_eta_k_tree used to return, {k: root}, including the
+        BottomTreeNode hung under every leaf
+        """
+        from app.algo.tree.tree_construct import BottomTreeNode, TreeNode
+
+        nodes = [TreeNode(self.node_vertexes(x).tolist(), int(self.k[x]), float(self.threshold[x]))
+                 for x in range(len(self))]
+        bottoms = {k: BottomTreeNode([], k, 1) for k in range(1, self.k_max() + 1)}
+        for x, node in enumerate(nodes):
+            bottoms[node.k].set_father(node)
+        for x, node in enumerate(nodes):
+            if self.parent[x] != -1:
+                node.set_father(nodes[self.parent[x]], bottoms[node.k])
+
+        return {k: nodes[self.roots[k]] if self.roots[k] != -1 else bottoms[k]
+                for k in range(self.k_max(), 0, -1)}
+
+    def tree_str(self, x: int) -> str:
+        """the same text as str(TreeNode), with the children in the order of the nodes"""
+        children = self.node_children(x)
+        return ','.join(str(v) for v in self.node_vertexes(x).tolist()) \
+            + ('->' + '->'.join([self.tree_str(c) for c in children.tolist()] if len(children) else ['buttom|']))
+
+    def __str__(self):
+        return '\n'.join(f'{k} {self.tree_str(self.roots[k])}' for k in range(self.k_max(), 0, -1)
+                         if self.roots[k] != -1)
+
+
+class ForestBuilder:
+    """collects the nodes of the trees one by one, build() packs them into a Forest"""
+
+    def __init__(self, vertex_num: int, k_max: int):
+        self.parent = array('q')
+        self.threshold = array('d')
+        self.k = array('i')
+        self.vertex_offsets = array('q', [0])
+        self.vertexes = array('i')
+        self.vertex_num = vertex_num
+        self.roots = array('q', [-1]) * (k_max + 1)
+
+    def add_node(self, k: int, threshold: float, vertexes: List[int]) -> int:
+        x = len(self.parent)
+        self.parent.append(-1)
+        self.threshold.append(threshold)
+        self.k.append(k)
+        self.vertexes.extend(vertexes)
+        self.vertex_offsets.append(len(self.vertexes))
+        return x
+
+    def set_parent(self, x: int, father: int):
+        self.parent[x] = father
+
+    def set_root(self, k: int, x: int):
+        while self.parent[x] != -1:
+            x = self.parent[x]
+        self.roots[k] = x
+
+    def build(self) -> Forest:
+        parent = np.frombuffer(self.parent, dtype=np.int64).copy()
+        child_offsets, children = _children(parent)
+
+        return Forest(parent, np.frombuffer(self.threshold, dtype=np.float64).copy(),
+                      np.frombuffer(self.k, dtype=np.int32).copy(),
+                      np.frombuffer(self.vertex_offsets, dtype=np.int64).copy(),
+                      np.frombuffer(self.vertexes, dtype=np.int32).copy(),
+                      child_offsets, children, np.frombuffer(self.roots, dtype=np.int64).copy(),
+                      self.vertex_num)
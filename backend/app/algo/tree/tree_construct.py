@@ -1,12 +1,13 @@
 # UCF Construct
-import sys
-import copy
-from typing import List
+from typing import Iterable, List
 
-import UCO
-import heap
-import decorate
-from maintenance.maintenance import delete_edges
+from app.algo.UCO import uco as UCO
+from app.algo.UCO.parallel import peel_in_parallel
+from app.algo import decorate
+from app.algo.sparse_graph import SparseGraph, as_sparse_graph
+from app.algo.tree.forest import Forest, ForestBuilder
+from app.algo.tree.union import UnionFindSet
+from app.algo.utils import core_decomposition
 
 
 class TreeNode:
@@ -16,6 +17,7 @@ class TreeNode:
     # upper_threshold: float
     # lower_threshold: float
     # father: 'TreeNode'
+    __slots__ = ('nodes', 'k', 'upper_threshold', 'lower_threshold', 'father', 'children')
 
     def __init__(self, nodes, k, threshold):
         self.nodes = nodes
@@ -47,14 +49,18 @@ class TreeNode:
 
 
 class BottomTreeNode(TreeNode):
+    __slots__ = ('father_set',)
+
     def __init__(self, nodes, k, threshold=1):
         super().__init__(nodes, k, threshold)
         self.father = list()
+        self.father_set = set()  # membership of self.father in O(1)
 
     def set_father(self, father: 'TreeNode'):
-        if father in self.father:
+        if father in self.father_set:
             return
         self.father.append(father)
+        self.father_set.add(father)
         father.children.add(self)
 
     def __str__(self):
@@ -62,247 +68,127 @@ class BottomTreeNode(TreeNode):
 
 
 @decorate.wrapper
-def construct_tree(graph: List[List[float]], threshold=0.01):
+def construct_tree(graph: SparseGraph, threshold=0.01, stats: UCO.PruningStats = None, workers: int = 1):
     """
     fin function of this proj
-    :param graph: the 2-D matrix of graph
-    :param threshold: the threshold that set to accelerate the parse of the tree
-    :return: TreeNode
+    :param graph: the graph in CSR layout
+    :param threshold: the threshold that set to accelerate the parse of the tree, the vertexes whose
+        k-prob can not pass it are pruned before peeling, so the trees are exact for eta >= threshold
+    :param stats: count the pruned vertexes
+    :param workers: the number of processes peeling the (k, component) units, see peel_in_parallel
+    :return: Forest, see to_tree_nodes for the TreeNode of every k
     """
     assert threshold <= 0.1, "threshold is too big"
+    graph = as_sparse_graph(graph)
     # compare core
-    core = cal_core(copy.deepcopy(graph))
-    cores = [[i, c] for i, c in enumerate(core)]
-
-    cores = sorted(cores, key=lambda x: x[1], reverse=True)
-    k_max = cores[0][1]
-    forest = {}
-    for k in range(k_max, 0, -1):        
-        temp_graph, vertex = extract_graph(graph, k, cores)
-        probs = [UCO.cal_prob(temp_graph, index, k) for index in vertex]
-        cur_thres = 0
+    core = cal_core(graph)
+    k_max = max(core, default=0)
+    levels = peel_in_parallel(graph, range(k_max, 0, -1), threshold, workers, stats, core)
+
+    builder = ForestBuilder(len(graph), k_max)
+    for k in range(k_max, 0, -1):
         S = list() # S is a stack
         eta_threshold = [0 for _ in range(len(graph))]
-        probs_index = [[prob, i] for i, prob in enumerate(probs)]
-        heaps = heap.Heap(probs_index, compare=lambda a, b: a[0] > b[0])
-        heaps.heapify()
-
-        while not UCO.graph_is_empty(temp_graph):
-            u = heaps.heap_pop()
-            cur_thres = max(cur_thres, u[0])
-            eta_threshold[u[1]] = cur_thres
-            S.append(u[1])
-
-            # remove v from vertex set
-            vertex.remove(u[1])
-            for i, neighbor in enumerate(temp_graph[u[1]]):
-                if neighbor != 0:
-                    # remove neighbor edge from map
-                    UCO.remove_edge_from_graph(temp_graph, u[1], i)
-
-                    # update k probs
-                    probs = [UCO.cal_prob(temp_graph, index, k) for index in vertex]
-                    probs_index = [[prob, i] for i, prob in zip(vertex, probs)]
-                    heaps = heap.Heap(probs_index, compare=lambda a, b: a[0] > b[0])
-                    heaps.heapify()
-
-        print('cal', k, S, eta_threshold)
-        forest[k] = construct_eta_k_tree(copy.deepcopy(graph), k, S, eta_threshold)
-    return forest
-
-
-def cal_core(graph: List[List[float]]):
-    n = len(graph)
-    core = list(range(n))
-    vertex = set(list(range(n)))
-    visited = [False for _ in range(n)]
-    while len(vertex) != 0:
-        degree = degree_certain_graph(graph)
-        index = find_min(degree, visited)
-        k = degree[index]
-        while index != -1 and degree[index] <= k:
-            core[index] = k
-            # remove edge
-            for i in range(n):
-                if graph[index][i] != 0:
-                    degree[i] -= 1
-                    degree[index] -= 1
-                    graph[index][i] = .0
-                    graph[i][index] = .0
-
-            visited[index] = True
-            vertex.remove(index)
-            # update index
-            index = find_min(degree, visited)
-
-    return core
-
-
-def find_min(degree, visited):
-    index, k = -1, sys.maxsize
-    for i, d in enumerate(degree):
-        if visited[i]:
-            continue
-        if d < k:
-            k = d
-            index = i
-
-    return index
-
-
-def degree_certain_graph(graph: List[List[float]]):
+        for u, cur_thres in levels[k]:
+            eta_threshold[u] = cur_thres
+            S.append(u)
+
+        add_eta_k_tree(builder, graph, k, S, eta_threshold)
+    return builder.build()
+
+
+def update_forest(forest: Forest, graph: SparseGraph, order: List[List[float]], levels: Iterable[int]) -> Forest:
+    """
+    rebuild the trees of levels from order and keep the trees of the other levels of forest, e.g.
+    after batch_core_maintenance reported the levels it changed. the levels above the k_max of
+    forest are added
+    :param forest: the forest of the graph before the updates
+    :param graph: the graph after the updates
+    :param order: the order of UCO_Index of graph
+    :param levels: the k whose thresholds changed
+    :return: the new forest, forest is left untouched
+    """
+    levels = sorted(levels)
+    builder = ForestBuilder(len(graph), max(levels, default=0))
+    for k in levels:
+        eta_threshold = [row[k - 1] if len(row) >= k else .0 for row in order]
+        S = sorted((v for v, row in enumerate(order) if len(row) >= k), key=eta_threshold.__getitem__)
+        add_eta_k_tree(builder, graph, k, S, eta_threshold)
+    return forest.replace_levels(levels, builder.build())
+
+
+def cal_core(graph: SparseGraph):
     """
-    calculate the origin degree of the graph
-    :param graph:
-    :return:
+    the core number of every vertex, see core_decomposition
     """
-    n = len(graph)
-    vertex = [0 for _ in range(n)]
-    for i, g in enumerate(graph):
-        for p in g:
-            if p != 0:
-                vertex[i] += 1
-    
-    return vertex
-
-
-def extract_graph(graph, k, cores):
-    vertex = []
-    for core in cores:
-        if core[1] >= k:
-            vertex.append(core[0])
-    
-    temp_graph = copy.deepcopy(graph)
-    delete_edges(temp_graph, vertex)
-    return temp_graph, set(vertex)
-
-
-def find_connected_component(graph, vertexes, visited: List[int]) -> List[List[int]]:
+    return core_decomposition(graph)
+
+
+def construct_eta_k_tree(graph: SparseGraph, k: int, stack: List[int], eta_threshold: List[float]) -> TreeNode:
     """
-    find the connected vertexes groups in the graph which the path should take the visited points into consideration.
-    :param graph:
-    :param vertexes:
-    :param visited: the points have already been visited before
-    :return: [[]]
+    the tree of k as TreeNode objects, see add_eta_k_tree
+    :return: the root of the tree which holds the component of the highest threshold
     """
-    if len(vertexes) <= 1:
-        return [vertexes]
-
-    vertex = vertexes.copy()
-
-    for i, v in enumerate(visited):
-        if v and i not in vertexes:
-            vertexes.append(i)
-
-    node_index, n, group = 0, len(vertexes), 0
-
-    res = [-1 for _ in range(n)]
-    res[node_index] = group
-
-    while node_index < n:
-        find_more = True
-        neighbor = set([i for i, v in enumerate(graph[vertexes[node_index]]) if v != 0])
-
-        while find_more:
-            find_more = False
-            for k, v in enumerate(vertexes):
-                if res[k] == -1 and v in neighbor:
-                    res[k] = res[node_index]
-                    find_more = True
-                    neighbor = neighbor | set([i for i, v in enumerate(graph[v]) if v != 0])
-        
-        i = 0
-        while i < n and res[i] != -1:
-            i += 1
-        node_index = i
-        group += 1
-        if node_index < n:
-            res[node_index] = group
-
-    ans = [[] for _ in range(group)]
-    # print('group', res, vertex)
-    for i, r in enumerate(res):
-        if vertexes[i] not in vertex:
-            continue
-        ans[r].append(vertexes[i])
-
-    return [a for a in ans if len(a) != 0]
-
-
-def find_neighbors(graph, vertexes):
-    neighbor = set()
-    for v in vertexes:
-        neighbor = neighbor | set([i for i, p in enumerate(graph[v]) if p != 0])
-    
-    return neighbor
-
-
-def find_node(bottom: TreeNode, v) -> TreeNode:
+    builder = ForestBuilder(len(graph), k)
+    add_eta_k_tree(builder, graph, k, stack, eta_threshold)
+    return builder.build().to_tree_nodes()[k]
+
+
+def add_eta_k_tree(builder: ForestBuilder, graph: SparseGraph, k: int, stack: List[int],
+                   eta_threshold: List[float]) -> int:
     """
-    find the node where v exists by dfs
-    :param bottom: the bottom TreeNode
-    :param v:
-    :return:
+    pop the vertexes from the highest threshold down, one group of equal thresholds at a time.
+    a union-find over the popped vertexes keeps the connected components of the (k, ct)-core, and
+    the tree of each component is found from its root in the union-find: a component of the group
+    becomes a node whose children are the trees of the components it joins together.
+    O(m * alpha(n)) for the whole tree
+    :param builder: the nodes are added to it
+    :param graph: the graph
+    :param k: k number
+    :param stack: the peeled vertexes, ascending by threshold
+    :param eta_threshold: the threshold of every vertex
+    :return: the root of the tree which holds the component of the highest threshold, -1 if empty
     """
-    if not bottom:
-        return None
-    if v in bottom.nodes:
-        return bottom
-    elif isinstance(bottom, BottomTreeNode):
-        for father in bottom.father:
-            node = find_node(father, v)
-            if node:
-                return node
-    else:
-        node = find_node(bottom.father, v)
-        if node:
-            return node
-
-
-def get_root(node: TreeNode) -> TreeNode:
-    if isinstance(node, BottomTreeNode):
-        return get_root(node.father[0]) if len(node.father) > 0 else node
-
-    while node.father:
-        # print('father: ', node.father)
-        node = node.father
-    return node
-
-
-def construct_eta_k_tree(graph: List[List[float]], k: int, stack: List[int], eta_threshold: List[float]):
-    bottom = BottomTreeNode([], k, 1)
-    visited = [False for _ in range(len(graph))]
-    while len(stack) != 0:
-        node = stack[-1]
-        stack = stack[:-1]
-        ct = eta_threshold[node]
-        H = [node]
-        while len(stack) != 0 and eta_threshold[stack[-1]] == ct:
-            H.append(stack[-1])
-            stack = stack[:-1]
-
-        # print('H', H, visited)
-        for connected in find_connected_component(graph, H, visited):
-            # print('connected', connected)
-            for c in connected:
-                visited[c] = True
-            x_treeNode = TreeNode(connected, k, ct)
-            bottom.set_father(x_treeNode)
-            for v in find_neighbors(graph, connected):
-                if v in connected or eta_threshold[v] < ct:
+    union_set = UnionFindSet(len(graph))
+    popped = bytearray(len(graph))
+    tree_of = {}  # the root of the union-find -> the root node of its tree
+    first = -1
+
+    top = len(stack)
+    while top != 0:
+        ct = eta_threshold[stack[top - 1]]
+        low = top - 1
+        while low != 0 and eta_threshold[stack[low - 1]] == ct:
+            low -= 1
+        H = stack[low:top][::-1]
+        top = low
+
+        for v in H:
+            popped[v] = 1
+        # the trees which the components of the group absorb
+        absorbed = {}
+        for v in H:
+            for u in graph.neighbors_of(v):
+                if not popped[u]:
                     continue
-                # 1. get the node containing v (Y)
-                # print(v, eta_threshold[v], ct, [i.nodes for i in bottom.father])
-                y_treeNode = find_node(bottom, v)
-                # 2. get the root of Y (Z)
-                z_treenode = get_root(y_treeNode)
-                # print("get root: ", z_treenode.get_threshold(), 'node is:', x_treeNode.get_threshold())
-                if z_treenode.get_threshold() > x_treeNode.get_threshold():
-                    z_treenode.set_father(x_treeNode, bottom)
-                else:
-                    x_treeNode.merge_node(z_treenode)
-
-    return get_root(bottom)
+                ru = union_set.find(u)
+                if ru in tree_of:
+                    absorbed.setdefault(ru, tree_of.pop(ru))
+                union_set.union(v, ru)
+
+        components = {}
+        for v in H:
+            components.setdefault(union_set.find(v), []).append(v)
+        x_nodes = {r: builder.add_node(k, ct, connected) for r, connected in components.items()}
+        for ru, z_node in absorbed.items():
+            builder.set_parent(z_node, x_nodes[union_set.find(ru)])
+        tree_of.update(x_nodes)
+        if first == -1 and x_nodes:
+            first = next(iter(x_nodes.values()))
+
+    if first != -1:
+        builder.set_root(k, first)
+    return builder.roots[k]
 
 
 if __name__ == '__main__':
@@ -319,5 +205,4 @@ if __name__ == '__main__':
         [.0, .0, .0, .0, .0, .0, .8, .0, .8, .0],
     ]
 
-    for k, tree in construct_tree(graph).items():
-        print(k, tree)
+    print(construct_tree(graph))
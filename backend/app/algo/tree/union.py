@@ -1,43 +1,95 @@
+from array import array
+from typing import Iterable, Tuple
+
+import numpy as np
+
+
 class UnionFindSet:
+    """
+    union-find over the integers 0 .. n - 1, the parents and the sizes are int64 arrays so that
+    10 ** 7 elements take 160MB instead of two dicts.
+    find halves the path iteratively, union hangs the smaller set under the bigger one, and the
+    size is only meaningful for the roots.
+    find_many and labels work on numpy views of the same arrays.
+    """
+    father: array
+    size: array
+
     def __init__(self, data_list):
-        self.father_dict = {}
-        self.size_dict = {}
-
-        for node in data_list:
-            self.father_dict[node] = node
-            self.size_dict[node] = 1
-    
-    def find(self, node):
         """
-        使用递归的方式来查找父节点
-        在查找父节点的时候，顺便把当前节点移动到父节点上面
+        :param data_list: the number of elements, or the elements themselves, which are the
+            integers 0 .. max(data_list)
         """
-        father = self.father_dict[node]
-        if node != father:
-            if father != self.father_dict[father]:
-                self.size_dict[father] -= 1
-            father = self.find(father)
-        self.father_dict[node] = father
-        return father
-
-    def is_same_set(self, node_a, node_b):
+        n = data_list if isinstance(data_list, int) else max(data_list, default=-1) + 1
+        self.father = array('q', np.arange(n, dtype=np.int64).tobytes())
+        self.size = array('q', [1]) * n
+
+    def __len__(self) -> int:
+        return len(self.father)
+
+    def find(self, node: int) -> int:
+        father = self.father
+        while father[node] != node:
+            father[node] = father[father[node]]
+            node = father[node]
+        return node
+
+    def is_same_set(self, node_a: int, node_b: int) -> bool:
         return self.find(node_a) == self.find(node_b)
 
-    def union(self, node_a, node_b):
+    def union(self, node_a: int, node_b: int) -> int:
         """
         将两个集合合并在一起
+        :return: the root of the merged set
         """
         if node_a is None or node_b is None:
-            return
+            return None
 
         a_head, b_head = self.find(node_a), self.find(node_b)
+        if a_head == b_head:
+            return a_head
+
+        size = self.size
+        if size[a_head] < size[b_head]:
+            a_head, b_head = b_head, a_head
+        self.father[b_head] = a_head
+        size[a_head] += size[b_head]
+        return a_head
+
+    def union_many(self, edges: Iterable[Tuple[int, int]]):
+        """union both ends of every edge, edges may be a (m, 2) array as well"""
+        if isinstance(edges, np.ndarray):
+            edges = edges.tolist()
+        union = self.union
+        for a, b in edges:
+            union(a, b)
+
+    def find_many(self, vertices) -> np.ndarray:
+        """
+        the roots of vertices at once by pointer jumping, and the paths of vertices are
+        compressed to their roots
+        """
+        father = np.frombuffer(self.father, dtype=np.int64)
+        vertices = np.asarray(vertices, dtype=np.int64)
+        roots = father[vertices]
+        while True:
+            grand = father[roots]
+            if np.array_equal(grand, roots):
+                break
+            roots = grand
+        father[vertices] = roots
+        return roots
+
+    def labels(self) -> np.ndarray:
+        """the root of every element, see component_labels"""
+        return self.find_many(np.arange(len(self)))
 
-        if a_head != b_head:
-            a_set_size, b_set_size = self.size_dict[a_head], self.size_dict[b_head]
-            if a_set_size >= b_set_size:
-                self.father_dict[b_head] = a_head
-                self.size_dict[a_head] = a_set_size + b_set_size
-            else:
-                self.father_dict[a_head] = b_head
-                self.size_dict[b_head] = a_set_size + b_set_size
 
+def component_labels(roots: np.ndarray) -> np.ndarray:
+    """
+    relabel the roots of find_many to 0, 1, ... in the order of their first appearance
+    """
+    _, first, inverse = np.unique(roots, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+    return rank[inverse.reshape(-1)]
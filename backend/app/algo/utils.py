@@ -0,0 +1,81 @@
+from typing import Iterable, List
+
+import numpy as np
+
+from app.algo.sparse_graph import SparseGraph
+from app.algo.tree.union import UnionFindSet, component_labels
+
+
+def core_decomposition(graph: SparseGraph) -> List[int]:
+    """
+    deterministic core number of every vertex with the bucket queue of Batagelj and Zaversnik,
+    O(n + m). removed vertexes get core 0.
+    a vertex whose core number is below k has no chance to own k neighbors in any subgraph, so
+    the core number bounds every (k, eta) threshold.
+    :param graph: not changed
+    :return: core
+    """
+    n = len(graph)
+    degree = [0 if graph.is_removed(v) else graph.degree(v) for v in range(n)]
+    max_degree = max(degree, default=0)
+
+    # bucket[d] is the first position of the vertexes with degree d in vert
+    bucket = [0 for _ in range(max_degree + 1)]
+    for d in degree:
+        bucket[d] += 1
+    start = 0
+    for d in range(max_degree + 1):
+        bucket[d], start = start, start + bucket[d]
+
+    pos, vert = [0 for _ in range(n)], [0 for _ in range(n)]
+    for v in range(n):
+        pos[v] = bucket[degree[v]]
+        vert[pos[v]] = v
+        bucket[degree[v]] += 1
+    for d in range(max_degree, 0, -1):
+        bucket[d] = bucket[d - 1]
+    bucket[0] = 0
+
+    for i in range(n):
+        v = vert[i]
+        for u in graph.neighbors_of(v):
+            if degree[u] > degree[v]:
+                # move u to the front of its bucket and then to the bucket below
+                du, pu = degree[u], pos[u]
+                pw = bucket[du]
+                w = vert[pw]
+                if u != w:
+                    pos[u], pos[w] = pw, pu
+                    vert[pu], vert[pw] = w, u
+                bucket[du] += 1
+                degree[u] -= 1
+
+    return degree
+
+
+def connected_components(graph: SparseGraph, vertexes: Iterable[int] = None) -> List[List[int]]:
+    """
+    the connected components of the live vertexes owning an edge, or of the subgraph induced by
+    vertexes when given, each of them sorted. the components are ordered by their smallest vertex
+    """
+    if vertexes is None:
+        vertexes = [v for v in range(len(graph)) if not graph.is_removed(v) and graph.has_edges(v)]
+    vertexes = np.unique(np.asarray(list(vertexes), dtype=np.int64))
+    inside = np.zeros(len(graph), dtype=bool)
+    inside[vertexes] = True
+    inside &= np.frombuffer(graph.removed, dtype=np.uint8) == 0
+
+    # the live edges between the vertexes, each of them once
+    offsets = np.asarray(graph.offsets)
+    sources = np.repeat(np.arange(len(graph)), np.diff(offsets))
+    targets = np.asarray(graph.neighbors)
+    keep = (sources < targets) & inside[sources] & inside[targets] & (np.asarray(graph.probs) != 0)
+
+    union_set = UnionFindSet(len(graph))
+    union_set.union_many(np.stack([sources[keep], targets[keep]], axis=1))
+    labels = component_labels(union_set.find_many(vertexes))
+
+    res = [[] for _ in range(labels.max(initial=-1) + 1)]
+    for v, label in zip(vertexes.tolist(), labels.tolist()):
+        res[label].append(v)
+    return res
@@ -1,5 +1,6 @@
 from datetime import datetime
 from flask_login import UserMixin
+from sqlalchemy import inspect, text
 from . import db
 
 class User(UserMixin, db.Model):
@@ -9,14 +10,48 @@ class User(UserMixin, db.Model):
     graphs = db.relationship('Graph', backref='author', lazy='dynamic')
 
 class Graph(db.Model):
+    # 索引和森林的构建状态
+    PENDING, READY, FAILED = 'pending', 'ready', 'failed'
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     filename = db.Column(db.String(140), unique=True)  # 增加唯一约束
     data = db.Column(db.String(256)) 
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    edge_count = db.Column(db.Integer) 
+    edge_count = db.Column(db.Integer)  # 上传的边行数
+    vertex_num = db.Column(db.Integer)  # n
+    edge_num = db.Column(db.Integer)  # m，去重后概率非零的边数
+    status = db.Column(db.String(16), default=PENDING)  # 旧的记录为空，查询时再构建森林
 
 class QueryCache(db.Model):
-    id = db.Column(db.String(32), primary_key=True)  # MD5 hash
-    result = db.Column(db.Text)
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
\ No newline at end of file
+    # 每个 (图, k) 一条记录：第 k 层的顶点按阈值升序排列，任意 eta 的 (k, eta)-core 都是二分查找后的一段后缀
+    # 旧表按 md5(k, eta, graph_id) 存 JSON 文本，结构不同，换用新表名
+    __tablename__ = 'query_cache_level'
+    __table_args__ = (db.UniqueConstraint('graph_id', 'k'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    graph_id = db.Column(db.Integer, db.ForeignKey('graph.id'), index=True)
+    k = db.Column(db.Integer)
+    vertexes = db.Column(db.LargeBinary)  # int32
+    thresholds = db.Column(db.LargeBinary)  # float32，升序，同索引文件
+    version = db.Column(db.BigInteger)  # 缓存时索引文件的 mtime (ns)，索引被改写后记录失效
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+def add_missing_columns():
+    """
+    db.create_all 只创建缺失的表，不会修改已有的表：给已有的表补上模型中新增的列，
+    旧的记录上这些列为空
+    """
+    inspector = inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(
+                    f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}'))
@@ -1,14 +1,61 @@
 import os
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
-import numpy as np
-from app.models import Graph, db
-from app.utils.graph_parser import pipeline_read_data
+from app.models import Graph, QueryCache, db
+from app.utils.graph_parser import ingest_graph_file, read_graph_file
+from app.utils.graph_snapshot import load_snapshot, save_snapshot, snapshot_meta, snapshot_path
+from app.utils.index_file import index_path
+from app.algo.query import build_index, forest_path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import multiprocessing
+import threading
 import uuid
 import datetime
 
 graph_bp = Blueprint('graph', __name__)
 
+# 构建索引的后台进程：剥离是纯 Python 计算，放在 Web 进程的线程里会一直占着 GIL、拖慢所有请求。
+# 一次只构建一个图，避免多个构建抢占 CPU；用 fork 启动，子进程不必重新导入并创建 app
+build_executor = None
+build_executor_lock = threading.Lock()
+
+def get_build_executor():
+    """第一次上传时才创建构建进程"""
+    global build_executor
+    with build_executor_lock:
+        if build_executor is None:
+            build_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork'))
+        return build_executor
+
+def drop_build_executor(executor):
+    """构建进程意外退出（如被 OOM 杀掉）后进程池不能再提交任务，丢弃它，下次提交时重新创建"""
+    global build_executor
+    with build_executor_lock:
+        if build_executor is executor:
+            build_executor = None
+
+def submit_build(app, graph_id, filename):
+    """把图的索引构建提交到构建进程，完成后由 finish_build 更新状态"""
+    filepath = os.path.join(get_upload_folder(), filename)
+    executor = get_build_executor()
+    try:
+        future = executor.submit(build_index, filepath)
+    except BrokenProcessPool:
+        drop_build_executor(executor)
+        future = get_build_executor().submit(build_index, filepath)
+    future.add_done_callback(partial(finish_build, app, graph_id, filename))
+
+def requeue_pending_builds(app):
+    """启动时重新提交上次退出时仍在构建的图，图文件已不存在的标记为失败"""
+    for graph in Graph.query.filter_by(status=Graph.PENDING).all():
+        if os.path.exists(os.path.join(get_upload_folder(), graph.data)):
+            submit_build(app, graph.id, graph.data)
+        else:
+            graph.status = Graph.FAILED
+    db.session.commit()
+
 # 确保上传目录存在
 def get_upload_folder():
     """
@@ -21,47 +68,64 @@ def get_upload_folder():
     return upload_folder
 
 def save_graph_file(data_stream, filename):
-    """将图数据保存到文件"""
+    """
+    将上传的数据流逐块解析、校验后写入图文件及其二进制快照，不会构造邻接矩阵
+    :return: (图, 读到的边数)
+    """
     filepath = os.path.join(get_upload_folder(), filename)
-    # 先解析验证数据
-    matrix = pipeline_read_data(data_stream)
-    edges = adjacency_to_edges(matrix)
-    # 保存到文件
-    with open(filepath, 'w') as f:
-        for u, v, p in edges:
-            f.write(f"{u},{v},{p}\n")
-    return len(edges)
+    return ingest_graph_file(data_stream, filepath)
 
-def load_graph_file(filename):
-    """从文件加载图数据"""
+def load_graph(filename):
+    """加载图，优先映射二进制快照；快照缺失或过期时解析文本文件并重新生成快照"""
     filepath = os.path.join(get_upload_folder(), filename)
     if not os.path.exists(filepath):
+        return None
+    graph = load_snapshot(filepath)
+    if graph is None:
+        graph = read_graph_file(filepath)
+        save_snapshot(filepath, graph)
+    return graph
+
+def load_graph_file(filename):
+    """从文件加载图数据，返回 [u, v, p] 形式的边"""
+    graph = load_graph(filename)
+    if graph is None:
         return []
-    with open(filepath, 'r') as f:
-        return [line.strip().split(',') for line in f.readlines()]
+    return [[str(u), str(v), str(p)] for u, v, p in zip(*(a.tolist() for a in graph.edge_arrays()))]
+
+def graph_edge_count(filename):
+    """边数，从快照的文件头读取"""
+    filepath = os.path.join(get_upload_folder(), filename)
+    meta = snapshot_meta(filepath)
+    if meta is None:
+        graph = load_graph(filename)
+        return 0 if graph is None else len(graph.edge_arrays()[0])
+    return meta['edge_count']
 
 def delete_graph_file(filename):
-    """删除图文件"""
+    """删除图文件及其快照、索引文件、森林文件"""
     filepath = os.path.join(get_upload_folder(), filename)
-    if os.path.exists(filepath):
-        os.remove(filepath)
-
-def adjacency_to_edges(matrix):
-    edges = []
-    rows, cols = matrix.shape
-    for u in range(rows):
-        for v in range(u + 1, cols):
-            p = matrix[u, v]
-            if p > 0:
-                edges.append((u, v, p))
-    return edges
-
-def edges_to_adjacency(edges, size):
-    matrix = np.zeros((size, size), dtype=float)
-    for u, v, p in edges:
-        matrix[u, v] = p
-        matrix[v, u] = p
-    return matrix
+    for path in (filepath, snapshot_path(filepath), index_path(filepath), forest_path(filepath)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def finish_build(app, graph_id, filename, future):
+    """构建进程结束后更新图的状态，在 future 的回调线程中执行"""
+    with app.app_context():
+        try:
+            future.result()
+            status = Graph.READY
+        except Exception as e:
+            app.logger.error(f"Index build error: {str(e)}")
+            status = Graph.FAILED
+
+        graph = Graph.query.get(graph_id)
+        if graph is None:
+            # 构建期间图已被删除
+            delete_graph_file(filename)
+            return
+        graph.status = status
+        db.session.commit()
 
 @graph_bp.route('/upload', methods=['POST'])
 @login_required
@@ -73,32 +137,49 @@ def upload_graph():
     if file.filename == '':
         return jsonify({'error': 'Empty filename'}), 400
 
+    graph_id = None
     try:
         # 生成唯一文件名
         filename = f"{uuid.uuid4().hex}.graph"
-        # 保存文件并获取边数
-        edge_count = save_graph_file(file.stream, filename)
+        # 流式保存文件并获取点数、边数
+        graph, edge_count = save_graph_file(file.stream, filename)
         
         # 保存到数据库
         new_graph = Graph(
             user_id=current_user.id,
             filename=filename,
             data=filename,  # 现在存储文件名
-            timestamp=datetime.datetime.utcnow()
+            timestamp=datetime.datetime.utcnow(),
+            vertex_num=len(graph),
+            edge_num=graph.edge_num(),
+            edge_count=edge_count,
+            status=Graph.PENDING
         )
         db.session.add(new_graph)
         db.session.commit()
+        graph_id = new_graph.id
+
+        # 在后台构建索引和森林，之后的查询只需查表
+        submit_build(current_app._get_current_object(), graph_id, filename)
 
         return jsonify({
             'message': 'Graph uploaded successfully',
             'graph_id': new_graph.id,
-            'edge_count': edge_count
+            'vertex_num': new_graph.vertex_num,
+            'edge_num': new_graph.edge_num,
+            'edge_count': edge_count,
+            'status': new_graph.status
         }), 201
 
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
+        # 数据库写入或提交构建失败时不留下孤立的图文件和一直在构建中的记录
+        if graph_id is not None:
+            Graph.query.filter_by(id=graph_id).delete()
+            db.session.commit()
+        delete_graph_file(filename)
         # app.logger.error(f"Upload error: {str(e)}")
         return jsonify({'error': 'Server error'}), 500
 
@@ -110,7 +191,10 @@ def list_graphs():
         'id': g.id,
         'filename': g.filename,
         'timestamp': g.timestamp.isoformat(),
-        'edge_count': len(load_graph_file(g.data))  # 从文件获取边数
+        'vertex_num': g.vertex_num,
+        'status': g.status,
+        # 旧的记录没有边数，从快照获取
+        'edge_count': g.edge_num if g.edge_num is not None else graph_edge_count(g.data)
     } for g in graphs])
 
 @graph_bp.route('/<int:graph_id>', methods=['GET'])
@@ -127,6 +211,7 @@ def get_graph(graph_id):
     
     return jsonify({
         'id': graph.id,
+        'status': graph.status,
         'data': {
             'nodes': sorted(nodes, key=int),
             'edges': edges
@@ -143,7 +228,8 @@ def delete_graph(graph_id):
     try:
         # 先删除文件
         delete_graph_file(graph.data)
-        # 再删除数据库记录
+        # 再删除数据库记录及其查询缓存
+        QueryCache.query.filter_by(graph_id=graph.id).delete()
         db.session.delete(graph)
         db.session.commit()
         return jsonify({'message': 'Graph deleted successfully'})
@@ -1,9 +1,11 @@
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
 from app.models import Graph, QueryCache, db
-import hashlib
-import json
-import time
+from sqlalchemy.exc import IntegrityError
+from app.algo.query import index_version, k_level, level_core, load_forest
+from app.routes.graph import get_upload_folder
+import numpy as np
+import os
 import uuid
 import threading
 
@@ -13,34 +15,60 @@ query_bp = Blueprint('query', __name__)
 tasks = {}
 tasks_lock = threading.Lock()
 
-def generate_cache_key(params):
-    param_str = json.dumps(params, sort_keys=True)
-    return hashlib.md5(param_str.encode()).hexdigest()
-
-def background_task(task_id, edges, k, eta, graph_id):
+def load_cached_level(graph_id, k, version):
+    """缓存的第 k 层 (顶点, 阈值)，未命中时返回 None；索引改写过的旧记录直接删除"""
+    cached = QueryCache.query.filter_by(graph_id=graph_id, k=k).first()
+    if cached is None:
+        return None
+    if cached.version is None or cached.version != version:
+        db.session.delete(cached)
+        db.session.commit()
+        return None
+    return np.frombuffer(cached.vertexes, dtype=np.int32), np.frombuffer(cached.thresholds, dtype=np.float32)
+
+def fetch_level(graph_path, k):
+    """从索引取出第 k 层及索引的版本；读取期间索引被改写时版本为 None，这一层不缓存"""
+    version = index_version(graph_path)
+    level = k_level(graph_path, k)
+    if version is None or index_version(graph_path) != version:
+        return level, None
+    return level, version
+
+def cache_level(graph_id, k, version, vertexes, thresholds):
+    """缓存第 k 层，之后任意 eta 的查询都只需二分查找"""
+    if version is None or QueryCache.query.filter_by(graph_id=graph_id, k=k).first() is not None:
+        return
+    db.session.add(QueryCache(
+        graph_id=graph_id,
+        k=k,
+        vertexes=np.asarray(vertexes, dtype=np.int32).tobytes(),
+        thresholds=np.asarray(thresholds, dtype=np.float32).tobytes(),
+        version=version
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 另一个请求已经缓存了这一层
+        db.session.rollback()
+
+def index_not_ready(graph):
+    """索引未就绪时的响应；旧的记录没有状态，照旧在查询时构建森林"""
+    if graph.status == Graph.PENDING:
+        return jsonify({'status': 'PENDING', 'message': 'Index is building'}), 202
+    if graph.status == Graph.FAILED:
+        return jsonify({'status': 'FAILED', 'error': 'Index build failed'}), 500
+    return None
+
+def background_task(app, task_id, graph_path, k, eta, graph_id):
     """后台任务处理函数"""
     try:
-        # 执行核心计算（假设 async_k_eta_core 是同步函数）
-        result = async_k_eta_core(edges, k, eta)
-        
-        # 生成缓存键
-        cache_key = generate_cache_key({
-            'k': k,
-            'eta': eta,
-            'graph_id': graph_id
-        })
+        # 从图文件旁的索引中取出第 k 层，索引不存在时先构建
+        (vertexes, thresholds), version = fetch_level(graph_path, k)
+        result = level_core(vertexes, thresholds, eta)
 
-        # 在应用上下文中操作数据库
-        with current_app.app_context():
-            # 检查缓存是否存在
-            if not QueryCache.query.get(cache_key):
-                new_cache = QueryCache(
-                    id=cache_key,
-                    result=json.dumps(result),
-                    timestamp=int(time.time())
-                )
-                db.session.add(new_cache)
-                db.session.commit()
+        # 在应用上下文中操作数据库（线程中没有 current_app）
+        with app.app_context():
+            cache_level(graph_id, k, version, vertexes, thresholds)
 
         # 更新任务状态
         with tasks_lock:
@@ -69,27 +97,25 @@ def submit_query():
     if not graph or graph.user_id != current_user.id:
         return jsonify({'error': 'Graph not found or unauthorized'}), 404
 
-    # 解析边数据
-    edges = []
-    if graph.data:
-        for line in graph.data.split('\n'):
-            parts = line.strip().split(',')
-            if len(parts) == 3:
-                u, v, p = parts
-                edges.append((u, v, float(p)))
-
-    # 检查缓存
-    cache_key = generate_cache_key({
-        'k': k,
-        'eta': eta,
-        'graph_id': graph_id
-    })
-    cached = QueryCache.query.get(cache_key)
-    
-    if cached:
+    not_ready = index_not_ready(graph)
+    if not_ready is not None:
+        return not_ready
+
+    # graph.data 存储的是图文件名
+    graph_path = os.path.join(get_upload_folder(), graph.data)
+
+    # 检查缓存：每个 (图, k) 缓存按阈值排序的一层，任意 eta 都由二分查找得到；
+    # 记录带着缓存时索引文件的版本，更新边改写索引后旧的记录不再命中
+    level = load_cached_level(graph_id, k, index_version(graph_path))
+    if level is None and graph.status == Graph.READY:
+        # 索引已在上传时构建好，直接查表并缓存这一层
+        level, version = fetch_level(graph_path, k)
+        cache_level(graph_id, k, version, *level)
+
+    if level is not None:
         return jsonify({
             'task_id': 'cached',
-            'result': json.loads(cached.result),
+            'result': level_core(*level, eta),
             'status': 'COMPLETED'
         })
 
@@ -102,14 +128,13 @@ def submit_query():
             'status': 'PENDING',
             'graph_id': graph_id,
             'k': k,
-            'eta': eta,
-            'edges': edges
+            'eta': eta
         }
 
     # 启动后台线程
     thread = threading.Thread(
         target=background_task,
-        args=(task_id, edges, k, eta, graph_id)
+        args=(current_app._get_current_object(), task_id, graph_path, k, eta, graph_id)
     )
     thread.start()
 
@@ -151,4 +176,39 @@ def get_result(task_id):
         return jsonify({
             'status': 'PENDING',
             'message': 'Task is processing'
-        })
\ No newline at end of file
+        })
+
+@query_bp.route('/community', methods=['POST'])
+@login_required
+def community_query():
+    """
+    查询包含 q 的 (k, eta)-core 连通分量，q 可以是一个顶点或顶点列表
+    """
+    data = request.get_json()
+    try:
+        k = int(data['k'])
+        eta = float(data['eta'])
+        graph_id = int(data['graph_id'])
+        batch = isinstance(data['q'], list)
+        qs = [int(q) for q in data['q']] if batch else [int(data['q'])]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid parameters'}), 400
+
+    # 验证图数据权限
+    graph = Graph.query.get(graph_id)
+    if not graph or graph.user_id != current_user.id:
+        return jsonify({'error': 'Graph not found or unauthorized'}), 404
+
+    not_ready = index_not_ready(graph)
+    if not_ready is not None:
+        return not_ready
+
+    forest = load_forest(os.path.join(get_upload_folder(), graph.data))
+    if any(not 0 <= q < forest.vertex_num() for q in qs):
+        return jsonify({'error': 'Vertex out of range'}), 400
+
+    result = [c.tolist() for c in forest.communities(qs, k, eta)]
+    return jsonify({
+        'status': 'COMPLETED',
+        'result': result if batch else result[0]
+    })
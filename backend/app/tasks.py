@@ -1,8 +1,8 @@
 from celery import Celery
-from app.algo.maintenance.maintenance import core_maintenance
+from app.algo.query import k_eta_core
 
 celery = Celery(__name__)
 
 @celery.task
-def async_k_eta_core(k, eta):
-    return core_maintenance(k, eta)
\ No newline at end of file
+def async_k_eta_core(graph_path, k, eta):
+    return k_eta_core(graph_path, k, eta)
\ No newline at end of file
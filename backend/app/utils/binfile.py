@@ -0,0 +1,95 @@
+"""
+a small container of named numpy arrays: the magic, the length of a JSON header and the header
+itself, then the raw arrays, each of them aligned to ALIGNMENT bytes. the header records the
+dtype, the shape and the offset of every array, plus the meta data of the file.
+load_arrays maps the file read-only, so the arrays are views of the page cache which every
+process reading the same file shares.
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+import numpy as np
+
+MAGIC = b'UCMBIN01'
+ALIGNMENT = 64
+
+
+def _align(n: int) -> int:
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+@contextmanager
+def replacing(path: str, mode: str = 'wb'):
+    """
+    open a temporary file next to path, which is renamed to path when the block ends and removed
+    if it raises. the temporary name is unique per call, so the threads and the processes writing
+    the same path do not take each other's file, the last rename wins
+    """
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                     dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def save_arrays(path: str, arrays: Dict[str, np.ndarray], meta: dict = None, kind: str = ''):
+    """
+    write arrays to path. the file is written next to path and renamed, so a reader never sees
+    half of it, see replacing
+    :param path: the file
+    :param arrays: name -> array, saved in C order
+    :param meta: anything JSON can hold
+    :param kind: what the file holds, checked by load_arrays
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    entries, offset = {}, 0
+    for name, array in arrays.items():
+        entries[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'kind': kind, 'meta': meta or {}, 'arrays': entries}).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    with replacing(path) as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, array in arrays.items():
+            f.seek(data_start + entries[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+
+def load_arrays(path: str, kind: str = '') -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    map the file written by save_arrays, the arrays are read-only and nothing is copied
+    :param path: the file
+    :param kind: raise ValueError if the file holds something else
+    :return: (name -> array, meta)
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(len(MAGIC) + 8)
+        if len(prefix) < len(MAGIC) + 8 or prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a binary array file")
+        header_length = struct.unpack('<Q', prefix[len(MAGIC):])[0]
+        header = json.loads(f.read(header_length))
+        if header['kind'] != kind:
+            raise ValueError(f"{path} holds {header['kind']!r}, not {kind!r}")
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data_start = _align(len(MAGIC) + 8 + header_length)
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + entry['offset'])
+        arrays[name] = array.reshape(entry['shape'])
+
+    return arrays, header['meta']
@@ -1,32 +1,179 @@
 import os
 import random
-from typing import List
+from contextlib import nullcontext
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+
+from app.algo.sparse_graph import SparseGraph
+from app.utils.binfile import replacing
+from app.utils.graph_snapshot import load_snapshot, save_snapshot
 
 DATA_PATH = './data/graph_data'
+# bytes read at a time by the streaming parser
+CHUNK_SIZE = 1 << 22
+# the CSR arrays and the index take memory for every id up to the largest one, so an upload may
+# not use ids above max(MAX_SPARE_IDS, MAX_IDS_PER_EDGE * edge lines)
+MAX_IDS_PER_EDGE = 16
+MAX_SPARE_IDS = 1 << 20
 
+# the separators of the .mtx / .edges.convert files and the .graph files are all turned into spaces
+_SEPARATORS = bytes.maketrans(b',\t\r', b'   ')
+_COMMENTS = (b'%', b'#')
+
+Edges = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+def _open_source(source: Union[str, BinaryIO]):
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, 'rb')
+    # a stream is read from where it is and left open for the caller
+    return nullcontext(source)
+
+
+def _is_edge_line(line: bytes) -> bool:
+    return bool(line.split()) and not line.lstrip().startswith(_COMMENTS)
+
+
+def _iter_lines_blocks(fi, chunk_size: int) -> Iterator[bytes]:
+    """blocks of whole lines, every block ends with a newline"""
+    rest = b''
+    while True:
+        chunk = fi.read(chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        cut = chunk.rfind(b'\n')
+        if cut == -1:
+            rest += chunk
+            continue
+        yield rest + chunk[:cut + 1]
+        rest = chunk[cut + 1:]
+    if rest.strip():
+        yield rest + b'\n'
 
-def read_file(path: str):
-    index = []
-    max_prob = .0
-    max_index = 0
-    with open(path, 'r') as fi:
-        lines = fi.readlines()
-        for line in lines:
-            info = line.split(" ")
-            assert (len(info) >= 3 or info[1] == info[2]), "file's format is incorrect."
-            v1, v2, prob = int(info[0]), int(info[1]), float(info[2])
 
-            max_prob = max(max_prob, prob)
-            max_index = max(max_index, max(v1, v2))
-            index.append([v1, v2, prob])
+def _fields_per_line(block: bytes) -> np.ndarray:
+    """the number of fields on every line of a block which ends with a newline"""
+    data = np.frombuffer(block, dtype=np.uint8)
+    blank = data <= ord(' ')
+    starts = ~blank
+    starts[1:] &= blank[:-1]
+    lines = np.flatnonzero(data == ord('\n'))
+    lines[1:] = lines[:-1] + 1
+    lines[:1] = 0
+    return np.add.reduceat(starts, lines, dtype=np.int64)
 
-    return index, max_prob, max_index + 1
 
+def _parse_lines(block: bytes) -> np.ndarray:
+    """the slow path for blocks with comments, blank lines or ragged lines"""
+    rows = []
+    for line in block.split(b'\n'):
+        info = line.split()
+        if not info or line.lstrip().startswith(_COMMENTS):
+            continue
+        if len(info) < 2:
+            raise ValueError(f"file's format is incorrect: {line.decode(errors='replace')!r}")
+        rows.append((float(info[0]), float(info[1]), float(info[2]) if len(info) >= 3 else 1.))
+    return np.array(rows, dtype=np.float64).reshape(-1, 3)
 
-def construct_map(index: List[List[int]], max_prob: float, max_index: int):
+
+def iter_edge_chunks(source: Union[str, BinaryIO], chunk_size: int = CHUNK_SIZE) -> Iterator[Edges]:
+    """
+    parse an edge list chunk by chunk, only one chunk of text is held at a time.
+    a line is "v1 v2 [prob]" separated by spaces, commas or tabs, the prob defaults to 1 and the
+    columns after the third are ignored. lines starting with % or # are comments, and the size line
+    after the %%MatrixMarket banner of a .mtx file is skipped. the vertexes are kept as they are in
+    the file
+    :param source: a path or a binary stream
+    :param chunk_size: the bytes read at a time
+    :return: (v1, v2, prob) of every chunk, int32, int32 and float64 arrays
+    """
+    columns, banner = 0, None
+    with _open_source(source) as fi:
+        for block in _iter_lines_blocks(fi, chunk_size):
+            block = block.translate(_SEPARATORS)
+            if not columns:
+                # the header lines are looked at one by one until the first edge
+                if banner is None:
+                    banner = block.lstrip().startswith(b'%%MatrixMarket')
+                lines = block.split(b'\n')
+                first = list(islice((i for i, line in enumerate(lines) if _is_edge_line(line)), 2))
+                if banner and first:
+                    # the rows, columns and entries line of the .mtx format
+                    banner = False
+                    first.pop(0)
+                if not first:
+                    continue
+                columns = len(lines[first[0]].split())
+                block = b'\n'.join(lines[first[0]:])
+
+            values = None
+            if b'%' not in block and b'#' not in block:
+                try:
+                    values = np.fromstring(block, dtype=np.float64, sep=' ')
+                except ValueError:
+                    values = None
+                # the same number of values as a table of columns is not enough, a short line
+                # and a long one would be read as two rows of the others
+                if values is not None and (values.size != columns * block.count(b'\n')
+                                           or (_fields_per_line(block) != columns).any()):
+                    values = None
+            if values is None or columns < 2:
+                table = _parse_lines(block)
+            elif columns == 2:
+                table = np.empty((values.size // 2, 3), dtype=np.float64)
+                table[:, :2] = values.reshape(-1, 2)
+                table[:, 2] = 1.
+            else:
+                table = values.reshape(-1, columns)[:, :3]
+
+            ends = table[:, :2]
+            if (ends < 0).any() or (ends != np.floor(ends)).any():
+                raise ValueError("file's format is incorrect: vertexes must be non-negative integers")
+            if (ends > np.iinfo(np.int32).max).any():
+                raise ValueError("file's format is incorrect: vertexes must be less than 2 ** 31")
+            if len(table):
+                yield table[:, 0].astype(np.int32), table[:, 1].astype(np.int32), np.ascontiguousarray(table[:, 2])
+
+
+def _concatenate_chunks(chunks: Iterable[Edges]) -> Edges:
+    """the chunks in three arrays, which grow by doubling"""
+    capacity, size = 1 << 16, 0
+    v1, v2, prob = np.empty(capacity, np.int32), np.empty(capacity, np.int32), np.empty(capacity, np.float64)
+    for a, b, p in chunks:
+        if size + len(a) > capacity:
+            while size + len(a) > capacity:
+                capacity *= 2
+            v1, v2, prob = (np.resize(x, capacity) for x in (v1, v2, prob))
+        v1[size:size + len(a)], v2[size:size + len(a)], prob[size:size + len(a)] = a, b, p
+        size += len(a)
+    return v1[:size].copy(), v2[:size].copy(), prob[:size].copy()
+
+
+def read_edges(source: Union[str, BinaryIO], chunk_size: int = CHUNK_SIZE) -> Edges:
+    """
+    the whole edge list of iter_edge_chunks
+    :return: (v1, v2, prob)
+    """
+    return _concatenate_chunks(iter_edge_chunks(source, chunk_size))
+
+
+def read_file(path: str):
+    """
+    :return: the edges (v1, v2, prob) as arrays, the max prob and the number of vertexes
+    """
+    v1, v2, prob = read_edges(path)
+    max_prob = float(prob.max()) if len(prob) else .0
+    max_index = int(max(v1.max(), v2.max())) if len(v1) else -1
+    return (v1, v2, prob), max_prob, max_index + 1
+
+
+def construct_map(index: Edges, max_prob: float, max_index: int):
     maps = [[0 for _ in range(max_index)] for _ in range(max_index)]
-    for i in index:
-        v1, v2, prob = i[0], i[1], i[2]
+    for v1, v2, prob in zip(*(x.tolist() for x in index)):
         # if random.random() < 0.8:
         #     prob = 0
         maps[v1][v2] = prob / max_prob
@@ -35,41 +182,136 @@ def construct_map(index: List[List[int]], max_prob: float, max_index: int):
     return maps
 
 
-def pipeline_read_data(filename: str) -> List[List[float]]:
+def construct_sparse_graph(index: Edges, max_prob: float, max_index: int) -> SparseGraph:
+    """
+    same as construct_map but stores the graph in CSR layout, which takes O(n + m) memory
+    """
+    v1, v2, prob = index
+    return SparseGraph.from_arrays(v1, v2, prob / max_prob if max_prob else prob, max_index)
+
+
+def pipeline_read_data(filename: str) -> SparseGraph:
     path = os.path.join(DATA_PATH, filename)
     index, max_prob, max_index = read_file(path)
-    return construct_map(index, max_prob, max_index)
+    return construct_sparse_graph(index, max_prob, max_index)
+
+
+def read_graph_file(path: str, writable: bool = True) -> SparseGraph:
+    """
+    read the v1,v2,prob lines which the uploaded graphs are saved as, the probs are kept as they are.
+    the snapshot of the file is mapped instead of parsing it when it is fresh, see load_snapshot
+    :param writable: whether the probs of the graph can be changed
+    """
+    graph = load_snapshot(path, writable)
+    if graph is not None:
+        return graph
+    v1, v2, prob = read_edges(path)
+    max_index = int(max(v1.max(), v2.max())) if len(v1) else -1
+    return SparseGraph.from_arrays(v1, v2, prob, max_index + 1)
+
+
+def _write_edges(fo, graph: SparseGraph):
+    for v1, v2, prob in graph.stored_edges():
+        if v1 < v2:
+            fo.write(f"{v1},{v2},{prob}\n")
+
+
+def write_graph_file(path: str, graph: SparseGraph):
+    """
+    write graph as the lines read_graph_file reads. the deleted edges are kept with prob 0, so the
+    graph read back has the same vertexes. the file is written next to path and renamed, and its
+    snapshot is saved after it
+    """
+    with replacing(path, 'w') as fo:
+        _write_edges(fo, graph)
+    save_snapshot(path, graph)
 
 
-def increase_prob(maps: List[List[int]]) -> List[int]:
+def ingest_graph_file(source: Union[str, BinaryIO], path: str, chunk_size: int = CHUNK_SIZE) -> Tuple[SparseGraph, int]:
+    """
+    stream an uploaded edge list into the graph file path and its snapshot. every chunk of
+    iter_edge_chunks is checked and appended to the text file at once, so the text is never held
+    as a whole, the edges are only kept in the compact arrays the snapshot is built from.
+    the probs must be finite and not negative, and the vertex ids may not be far beyond the number of
+    edges, see MAX_IDS_PER_EDGE. if some of the probs is above 1, all of them are divided
+    by the largest like pipeline_read_data does, and the text file is written again
+    :param source: a path or a binary stream, e.g. the body of the upload request
+    :param path: the graph file, see read_graph_file
+    :param chunk_size: the bytes read at a time
+    :return: (the graph, the number of edge lines read)
+    """
+    def append_to(fo, chunks: Iterable[Edges]) -> Iterator[Edges]:
+        for v1, v2, prob in chunks:
+            if not np.isfinite(prob).all() or (prob < 0).any():
+                raise ValueError("file's format is incorrect: probs must be finite and not negative")
+            fo.write(''.join(f"{a},{b},{p}\n" for a, b, p in zip(v1.tolist(), v2.tolist(), prob.tolist())))
+            yield v1, v2, prob
+
+    with replacing(path, 'w') as fo:
+        v1, v2, prob = _concatenate_chunks(append_to(fo, iter_edge_chunks(source, chunk_size)))
+        if len(v1) == 0:
+            raise ValueError("file's format is incorrect: no edges")
+        vertex_num = int(max(v1.max(), v2.max())) + 1
+        if vertex_num > max(MAX_SPARE_IDS, MAX_IDS_PER_EDGE * len(v1)):
+            raise ValueError(f"file's format is incorrect: vertex id {vertex_num - 1} is too large for "
+                             f"{len(v1)} edges, number the vertexes from 0 without large gaps")
+
+        max_prob = float(prob.max())
+        graph = SparseGraph.from_arrays(v1, v2, prob / max_prob if max_prob > 1 else prob, vertex_num)
+        if max_prob > 1:
+            fo.seek(0)
+            fo.truncate()
+            _write_edges(fo, graph)
+    save_snapshot(path, graph)
+
+    return graph, len(v1)
+
+
+def generate_random_graph(vertex_num: int, avg_degree: float, seed: int = 0) -> SparseGraph:
+    """
+    random uncertain graph for the benchmarks, the edges are drawn uniformly
+    :param vertex_num: the number of vertices
+    :param avg_degree: the expected average degree
+    :param seed: the random seed
+    :return: SparseGraph
+    """
+    rand = random.Random(seed)
+    edges = []
+    for _ in range(int(vertex_num * avg_degree / 2)):
+        v1, v2 = rand.randrange(vertex_num), rand.randrange(vertex_num)
+        edges.append((v1, v2, round(rand.uniform(.05, 1), 2)))
+
+    return SparseGraph.from_edges(edges, vertex_num)
+
+
+def increase_prob(maps: SparseGraph) -> List[int]:
     lens = len(maps)
     index1, index2 = -1, -1
     while index1 == index2:
         index1, index2 = random.randint(0, lens-1), random.randint(0, lens-1)
 
-    prob = 0.001
-    while prob >= 1:
-        prob = maps[index1][index2] - maps[index1][index2] * random.random() + 0.001
+    # somewhere between the current prob and 1
+    prob = maps.get_prob(index1, index2)
+    prob += (1 - prob) * random.random()
 
-    maps[index1][index2], maps[index2][index1] = prob, prob
+    maps.set_prob(index1, index2, prob)
     return [index1, index2]
 
 
-def decrease_prob(maps: List[List[int]]) -> List[int]:
+def decrease_prob(maps: SparseGraph) -> List[int]:
     lens = len(maps)
     index1, index2 = -1, -1
     while index1 == index2:
-        index1, index2 = random.randint(0, lens), random.randint(0, lens)
+        index1, index2 = random.randint(0, lens-1), random.randint(0, lens-1)
 
-    prob = -0.001
-    while prob < 0:
-        prob = maps[index1][index2] - maps[index1][index2] * random.random() + 0.001
+    # somewhere between 0 and the current prob
+    prob = maps.get_prob(index1, index2) * random.random()
 
-    maps[index1][index2], maps[index2][index1] = prob, prob
+    maps.set_prob(index1, index2, prob)
     return [index1, index2]
 
 
-def pipeline_change_map(maps: List[List[int]], increase_or_not: bool) -> List[int]:
+def pipeline_change_map(maps: SparseGraph, increase_or_not: bool) -> List[int]:
     if increase_or_not:
         return increase_prob(maps)
     else:
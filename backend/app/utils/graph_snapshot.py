@@ -0,0 +1,64 @@
+"""
+the binary snapshot of a graph file: the CSR arrays of its SparseGraph in a binfile saved next to
+it. loading a snapshot maps the file, so the graph is opened without parsing and without copying.
+the text file stays the source of truth, a snapshot older than it is ignored.
+"""
+import os
+from array import array
+from typing import Optional
+
+import numpy as np
+
+from app.algo.sparse_graph import SparseGraph
+from app.utils.binfile import load_arrays, save_arrays
+
+KIND = 'graph-snapshot'
+SUFFIX = '.snap'
+
+
+def snapshot_path(graph_path: str) -> str:
+    """the snapshot file of the graph file graph_path"""
+    return os.path.splitext(graph_path)[0] + SUFFIX
+
+
+def is_fresh(graph_path: str) -> bool:
+    """whether the snapshot of graph_path exists and is not older than it"""
+    path = snapshot_path(graph_path)
+    if not os.path.exists(path):
+        return False
+    return not os.path.exists(graph_path) or os.path.getmtime(path) >= os.path.getmtime(graph_path)
+
+
+def save_snapshot(graph_path: str, graph: SparseGraph):
+    """
+    save the CSR arrays of graph as the snapshot of graph_path, the deletion mask is not saved
+    """
+    v1, _, _ = graph.edge_arrays()
+    save_arrays(snapshot_path(graph_path), {
+        'offsets': np.asarray(graph.offsets, dtype=np.int64),
+        'neighbors': np.asarray(graph.neighbors, dtype=np.int32),
+        'probs': np.asarray(graph.probs, dtype=np.float64),
+    }, {'vertex_num': graph.vertex_num, 'edge_count': len(v1)}, KIND)
+
+
+def load_snapshot(graph_path: str, writable: bool = False) -> Optional[SparseGraph]:
+    """
+    the graph of the snapshot of graph_path, None if it is missing or stale
+    :param graph_path: the graph file
+    :param writable: copy the arrays out of the file. otherwise they are read-only memoryviews of
+        the mapped file, which index to python numbers like array does, and set_prob fails
+    """
+    if not is_fresh(graph_path):
+        return None
+    arrays, _ = load_arrays(snapshot_path(graph_path), KIND)
+    offsets, neighbors, probs = arrays['offsets'], arrays['neighbors'], arrays['probs']
+    if writable:
+        return SparseGraph(array('q', offsets.tobytes()), array('i', neighbors.tobytes()), array('d', probs.tobytes()))
+    return SparseGraph(memoryview(offsets), memoryview(neighbors), memoryview(probs))
+
+
+def snapshot_meta(graph_path: str) -> Optional[dict]:
+    """vertex_num and edge_count of the snapshot of graph_path, None if it is missing or stale"""
+    if not is_fresh(graph_path):
+        return None
+    return load_arrays(snapshot_path(graph_path), KIND)[1]
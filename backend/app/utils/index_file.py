@@ -0,0 +1,150 @@
+"""
+the UCO index in CSR arrays, saved as a binary file next to the graph it was built from.
+"""
+import os
+from typing import Iterable, List
+
+import numpy as np
+
+from app.utils.binfile import load_arrays, save_arrays
+
+KIND = 'uco-index'
+SUFFIX = '.uco'
+
+
+def index_path(graph_path: str) -> str:
+    """the index file of the graph file graph_path"""
+    return os.path.splitext(graph_path)[0] + SUFFIX
+
+
+def _pack_rows(order: List[List[float]]):
+    """
+    the rows of order in CSR arrays
+    :return: (the length of every row, offsets, float32 thresholds)
+    """
+    lengths = np.fromiter((len(row) for row in order), dtype=np.int64, count=len(order))
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    thresholds = np.fromiter((t for row in order for t in row), dtype=np.float32, count=offsets[-1])
+    return lengths, offsets, thresholds
+
+
+class ThresholdIndex:
+    """
+    the order of UCO_Index in flat arrays.
+    the thresholds of v for k = 1, 2, ... are thresholds[offsets[v]:offsets[v + 1]], and the vertexes
+    of level k are level_vertexes[level_offsets[k - 1]:level_offsets[k]], ascending by their threshold
+    which is at the same position of level_thresholds. so the (k, eta)-core is the tail of its level
+    found by one binary search.
+    the thresholds are float32, a query compares them with float32(eta).
+    """
+    offsets: np.ndarray
+    thresholds: np.ndarray
+    level_offsets: np.ndarray
+    level_vertexes: np.ndarray
+    level_thresholds: np.ndarray
+
+    def __init__(self, offsets, thresholds, level_offsets, level_vertexes, level_thresholds):
+        self.offsets = offsets
+        self.thresholds = thresholds
+        self.level_offsets = level_offsets
+        self.level_vertexes = level_vertexes
+        self.level_thresholds = level_thresholds
+
+    @classmethod
+    def from_order(cls, order: List[List[float]]) -> 'ThresholdIndex':
+        """
+        :param order: order[v][k - 1] is the threshold of v for k, see UCO_Index
+        """
+        lengths, offsets, thresholds = _pack_rows(order)
+
+        vertexes = np.repeat(np.arange(len(order), dtype=np.int32), lengths)
+        ks = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths) + 1
+        by_level = np.lexsort((vertexes, thresholds, ks))
+        k_max = int(lengths.max(initial=0))
+        level_offsets = np.searchsorted(ks[by_level], np.arange(1, k_max + 2)).astype(np.int64)
+
+        return cls(offsets, thresholds, level_offsets, vertexes[by_level], thresholds[by_level])
+
+    def replace_levels(self, order: List[List[float]], levels: Iterable[int]) -> 'ThresholdIndex':
+        """
+        the index of order, which only differs from self on levels, e.g. after batch_core_maintenance
+        reported the levels it changed. the rows are packed again, but only levels and the levels
+        above the k_max of self are sorted, the others are copied from self
+        """
+        lengths, offsets, thresholds = _pack_rows(order)
+
+        levels = set(levels)
+        level_vertexes, level_thresholds = [], []
+        for k in range(1, int(lengths.max(initial=0)) + 1):
+            if k in levels or k > self.k_max():
+                vertexes = np.nonzero(lengths >= k)[0].astype(np.int32)
+                vertex_thresholds = thresholds[offsets[vertexes] + k - 1]
+                by_threshold = np.lexsort((vertexes, vertex_thresholds))
+                vertexes, vertex_thresholds = vertexes[by_threshold], vertex_thresholds[by_threshold]
+            else:
+                vertexes, vertex_thresholds = self.level(k)
+            level_vertexes.append(vertexes)
+            level_thresholds.append(vertex_thresholds)
+
+        level_offsets = np.zeros(len(level_vertexes) + 1, dtype=np.int64)
+        np.cumsum([len(vertexes) for vertexes in level_vertexes], out=level_offsets[1:])
+        return ThresholdIndex(offsets, thresholds, level_offsets,
+                              np.concatenate(level_vertexes or [self.level_vertexes[:0]]),
+                              np.concatenate(level_thresholds or [self.level_thresholds[:0]]))
+
+    @classmethod
+    def load(cls, path: str) -> 'ThresholdIndex':
+        """map the file, the arrays are read-only views of it"""
+        arrays, _ = load_arrays(path, KIND)
+        return cls(arrays['offsets'], arrays['thresholds'], arrays['level_offsets'],
+                   arrays['level_vertexes'], arrays['level_thresholds'])
+
+    def save(self, path: str):
+        save_arrays(path, {
+            'offsets': self.offsets,
+            'thresholds': self.thresholds,
+            'level_offsets': self.level_offsets,
+            'level_vertexes': self.level_vertexes,
+            'level_thresholds': self.level_thresholds,
+        }, {'vertex_num': self.vertex_num(), 'k_max': self.k_max()}, KIND)
+
+    def vertex_num(self) -> int:
+        return len(self.offsets) - 1
+
+    def k_max(self) -> int:
+        """the largest k whose level is not empty"""
+        return len(self.level_offsets) - 1
+
+    def threshold(self, v: int, k: int) -> float:
+        """the threshold of v for k, 0 if it does not pass CUT_OFF"""
+        start, end = self.offsets[v], self.offsets[v + 1]
+        return float(self.thresholds[start + k - 1]) if 0 < k <= end - start else .0
+
+    def row(self, v: int) -> np.ndarray:
+        return self.thresholds[self.offsets[v]:self.offsets[v + 1]]
+
+    def level(self, k: int):
+        """(vertexes, thresholds) of level k, ascending by threshold"""
+        if not 0 < k <= self.k_max():
+            return self.level_vertexes[:0], self.level_thresholds[:0]
+        start, end = self.level_offsets[k - 1], self.level_offsets[k]
+        return self.level_vertexes[start:end], self.level_thresholds[start:end]
+
+    def core(self, k: int, eta: float) -> np.ndarray:
+        """the vertexes of the (k, eta)-core, ascending by threshold"""
+        vertexes, thresholds = self.level(k)
+        return vertexes[np.searchsorted(thresholds, np.float32(eta), side='left'):]
+
+    def core_mask(self, k: int, eta: float) -> np.ndarray:
+        """membership of every vertex in the (k, eta)-core"""
+        mask = np.zeros(self.vertex_num(), dtype=bool)
+        mask[self.core(k, eta)] = True
+        return mask
+
+    def contains(self, v: int, k: int, eta: float) -> bool:
+        start, end = self.offsets[v], self.offsets[v + 1]
+        return 0 < k <= end - start and self.thresholds[start + k - 1] >= np.float32(eta)
+
+    def to_order(self) -> List[List[float]]:
+        return [self.row(v).tolist() for v in range(self.vertex_num())]